@@ -6,91 +6,218 @@ from airflow.hooks.base_hook import BaseHook
 from airflow.operators.bash import BashOperator
 from airflow.operators.python_operator import PythonOperator
 
-from kaggle_elt.kaggle_dbt_source import KaggleDbtSource, read_kaggle_dbt_source_configs
-from kaggle_elt.kaggle_dataset_downloader import download_kaggle_file_with_credentials
+from kaggle_elt.kaggle_dbt_source import KaggleDbtSource, read_kaggle_dbt_source_configs_cached
+from kaggle_elt.kaggle_dataset_downloader import download_kaggle_files_with_credentials
 from kaggle_elt.kaggle_dbt_loader import load_csv_to_postgres
+from kaggle_elt.parquet_export import export_table_to_parquet, export_models_to_parquet
+from kaggle_elt.dbt_manifest import DbtModelBranch, get_source_model_branches_cached
+from typing import Any, Dict, List, Optional
 
-# Connections
-kaggle_api_conn = BaseHook.get_connection("kaggle_api")
-kaggle_db_conn = BaseHook.get_connection("postgres_db")
-# Variables
+# Connections. They are only looked up when the tasks run, so parsing the DAG doesn't hit the metastore
+kaggle_api_conn_id = 'kaggle_api'
+kaggle_db_conn_id = 'postgres_db'
+# Pools shared by the DAGs of all the datasets, limiting the concurrent downloads & loads (COPYs) across all of them.
+# The tasks take as many slots as workers they run, so a pool's size is the number of files downloaded or loaded at the same time
+kaggle_download_pool = 'kaggle_downloads'
+kaggle_load_pool = 'kaggle_loads'
+# Variables. Needed to find the dbt project while parsing, so they are read from the environment (AIRFLOW_VAR_*) when available
 dbt_path = Variable.get('dbt_path')
 dbt_project = Variable.get('dbt_project')
+parquet_dir = Variable.get('parquet_dir', default_var='/opt/parquet')
+download_dir = Variable.get('download_dir', default_var='/tmp')
 
 default_args = {'owner': 'airflow', 'start_date': datetime(2021, 1, 1)}
 
-def create_kaggle_dataset_table_extractor(dataset_table_name: str, dataset_cfg: KaggleDbtSource, download_dir: str = '/tmp') -> PythonOperator:
-    """Builds an airflow operator that downloads the kaggle dataset specified in the dbt source"""
-    table_cfg = dataset_cfg.get_table(dataset_table_name)
-    download_path = f'{download_dir}/{dataset_cfg.name}'
+def download_kaggle_files_with_connection(
+        dataset: str,
+        files: List[str],
+        kaggle_conn_id: str,
+        download_path: str,
+        max_workers: int,
+        unzip: bool=True
+    ) -> List[Dict[str, Any]]:
+    """Downloads kaggle dataset files concurrently with the credentials stored in an airflow connection"""
+    kaggle_api_conn = BaseHook.get_connection(kaggle_conn_id)
+    return download_kaggle_files_with_credentials(
+        dataset,
+        files,
+        kaggle_api_conn.login,
+        kaggle_api_conn.password,
+        download_path,
+        unzip=unzip,
+        max_workers=max_workers
+    )
+
+def load_csv_to_postgres_with_connection(
+        pg_conn_id: str,
+        source_cfg: KaggleDbtSource,
+        target_table: str,
+        download_dir: str,
+        from_zip: bool=False,
+        ti=None,
+        run_id: Optional[str] = None,
+        dag_run=None
+    ) -> List[Dict[str, Any]]:
+    """
+    Loads a kaggle dataset file into the database with the credentials stored in an airflow connection. The load isn't skipped
+    if the run is triggered with {"force": true} in its conf
+    """
+    force = bool(dag_run is not None and (dag_run.conf or {}).get('force', False))
+    return load_csv_to_postgres(
+        BaseHook.get_connection(pg_conn_id), source_cfg, target_table, download_dir, force=force, from_zip=from_zip, ti=ti, run_id=run_id
+    )
+
+def create_kaggle_dataset_extractor(dataset_cfg: KaggleDbtSource) -> PythonOperator:
+    """Builds an airflow operator that downloads the files of all the tables of the kaggle dataset specified in the dbt source"""
+    download_path = dataset_cfg.get_download_path(download_dir)
     return PythonOperator(
-        task_id=f'download_{table_cfg.name}',
-        python_callable=download_kaggle_file_with_credentials,
+        task_id=f'download_{dataset_cfg.name}',
+        python_callable=download_kaggle_files_with_connection,
+        pool=dataset_cfg.download_pool or kaggle_download_pool,
+        pool_slots=max(1, min(dataset_cfg.download_workers, len(dataset_cfg.tables))),
         op_args=[
             dataset_cfg.kaggle_full_name,
-            table_cfg.kaggle_file_name,
-            kaggle_api_conn.login,
-            kaggle_api_conn.password,
-            download_path
+            [t.kaggle_file_name for t in dataset_cfg.tables.values()],
+            kaggle_api_conn_id,
+            download_path,
+            dataset_cfg.download_workers,
+            # Streaming loads read the csv straight out of the zip files, so they aren't extracted
+            not dataset_cfg.streaming_load
         ]
     )
 
-def create_kaggle_dataset_table_loader(dataset_table_name: str, dataset_cfg: KaggleDbtSource, download_dir='/tmp') -> PythonOperator:
+def create_kaggle_dataset_table_loader(dataset_table_name: str, dataset_cfg: KaggleDbtSource) -> PythonOperator:
     """Builds an airflow operator that loads into the database the kaggle dataset specified in the dbt source"""
     return PythonOperator(
         task_id=f"load_{dataset_table_name}",
-        python_callable=load_csv_to_postgres,
+        python_callable=load_csv_to_postgres_with_connection,
+        pool=dataset_cfg.load_pool or kaggle_load_pool,
+        # A partitioned load runs a COPY per worker
+        pool_slots=max(1, dataset_cfg.get_table(dataset_table_name).load_workers),
         op_args=[
-            kaggle_db_conn,
+            kaggle_db_conn_id,
             dataset_cfg,
             dataset_table_name,
+            download_dir,
+            dataset_cfg.streaming_load
+        ]
+    )
+
+def export_models_to_parquet_with_connection(pg_conn_id: str, schema: str, model_prefix: str, parquet_dir: str) -> List[Dict[str, Any]]:
+    """Exports dbt models to parquet with the db credentials stored in an airflow connection"""
+    return export_models_to_parquet(BaseHook.get_connection(pg_conn_id), schema, model_prefix, parquet_dir)
+
+def create_kaggle_dataset_table_parquet_exporter(dataset_table_name: str, dataset_cfg: KaggleDbtSource) -> PythonOperator:
+    """Builds an airflow operator that writes a parquet snapshot of a table of the kaggle dataset specified in the dbt source"""
+    return PythonOperator(
+        task_id=f"export_parquet_{dataset_table_name}",
+        python_callable=export_table_to_parquet,
+        op_args=[
+            dataset_cfg,
+            dataset_table_name,
+            parquet_dir,
             download_dir
         ]
     )
 
-def create_dbt_operator(dbt_action: str, dbt_selector: str, dataset_cfg: KaggleDbtSource) -> BashOperator:
-    """Builds an airflow operator that runs models or tests in dbt with the global db credentials"""
-    if dbt_action == 'test':
-        task_id = f"dbt_test_{dbt_selector.split('.')[-1]}"
-    else:
-        task_id = f'dbt_{dbt_action}_{dataset_cfg.name}'
+def create_presentation_parquet_exporter(dataset_cfg: KaggleDbtSource) -> PythonOperator:
+    """Builds an airflow operator that writes parquet snapshots of the presentation models built on top of a given source"""
+    return PythonOperator(
+        task_id=f"export_parquet_{dataset_cfg.name}_presentation",
+        python_callable=export_models_to_parquet_with_connection,
+        op_args=[
+            kaggle_db_conn_id,
+            dbt_project,
+            f'pre_{dataset_cfg.name}__',
+            parquet_dir
+        ]
+    )
+
+def create_dbt_operator(dbt_action: str, dbt_selector: str, task_id: str, threads: Optional[int] = None) -> BashOperator:
+    """
+    Builds an airflow operator that runs models or tests in dbt with the global db credentials.
+    The env is templated, so the connection is only looked up when the task runs
+    """
+    threads_arg = f' --threads {threads}' if threads else ''
     return BashOperator(
         task_id=task_id,
-        bash_command=f"/home/airflow/.local/bin/dbt {dbt_action} --project-dir {dbt_path}/{dbt_project} -m {dbt_selector}",
+        bash_command=f"/home/airflow/.local/bin/dbt {dbt_action} --project-dir {dbt_path}/{dbt_project} -m {dbt_selector}{threads_arg}",
         env={
             'DBT_PROFILES_DIR': dbt_path,
-            'DBT_DB_HOST': kaggle_db_conn.host,
-            'DBT_DB_USER': kaggle_db_conn.login,
-            'DBT_DB_PASSWORD': kaggle_db_conn.password,
-            'DWH_PORT': str(kaggle_db_conn.port),
-            'DBT_DWH_DBNAME': kaggle_db_conn.schema,
+            'DBT_DB_HOST': f'{{{{ get_connection("{kaggle_db_conn_id}").host }}}}',
+            'DBT_DB_USER': f'{{{{ get_connection("{kaggle_db_conn_id}").login }}}}',
+            'DBT_DB_PASSWORD': f'{{{{ get_connection("{kaggle_db_conn_id}").password }}}}',
+            'DWH_PORT': f'{{{{ get_connection("{kaggle_db_conn_id}").port }}}}',
+            'DBT_DWH_DBNAME': f'{{{{ get_connection("{kaggle_db_conn_id}").schema }}}}',
             'DBT_SCHEMA': dbt_project
         }
     )
 
-def create_kaggle_dataset_table_tester(dataset_table_name: str, dataset_cfg: KaggleDbtSource):
-    """Builds an airflow operator that runs dbt tests"""
-    return create_dbt_operator('test', f'source:{dataset_cfg.name}.{dataset_table_name}', dataset_cfg)
+def create_kaggle_dataset_tester(dataset_cfg: KaggleDbtSource) -> BashOperator:
+    """Builds an airflow operator that runs the dbt tests of all the tables of a source in a single dbt invocation"""
+    return create_dbt_operator('test', f'source:{dataset_cfg.name}', f'dbt_test_{dataset_cfg.name}', dataset_cfg.dbt_threads)
 
-def create_dbt_runner(dataset_cfg: KaggleDbtSource):
+def create_dbt_runner(dataset_cfg: KaggleDbtSource) -> BashOperator:
     """Builds an airflow operator that runs all dbt models that depend on a given source"""
-    return create_dbt_operator('run', dataset_cfg.name, dataset_cfg)
+    return create_dbt_operator('run', dataset_cfg.name, f'dbt_run_{dataset_cfg.name}')
+
+def create_dbt_branch_runner(branch: DbtModelBranch) -> BashOperator:
+    """Builds an airflow operator that runs the dbt models of a branch, i.e. those that depend on the same source tables"""
+    return create_dbt_operator('run', ' '.join(branch.models), f'dbt_run_{branch.name}', len(branch.models))
 
 def create_kaggle_elt_dag(dataset_cfg, schedule, default_args):
     """Builds an Airflow ELT DAG based on the configuration specified in the dbt source"""
-    dag = DAG(f'{dataset_cfg.name}_elt', schedule_interval=schedule, default_args=default_args)
+    dag = DAG(
+        f'{dataset_cfg.name}_elt',
+        schedule_interval=schedule,
+        default_args=default_args,
+        # Runs of the same dataset would load the same shadow tables, and there's no point in loading past versions of a dataset
+        max_active_runs=1,
+        catchup=False,
+        user_defined_macros={'get_connection': BaseHook.get_connection}
+    )
     with dag:
-        transform_op = create_dbt_runner(dataset_cfg)
+        # All the tests of the source are run by a single dbt invocation once all the tables are loaded
+        tester_op = create_kaggle_dataset_tester(dataset_cfg)
+        # All the files of the dataset are downloaded by a single task, at the same time, so they count against the download pool
+        # even if they are streamed into the db out of the zip files
+        extract_op = create_kaggle_dataset_extractor(dataset_cfg)
+        loader_ops = {}
         for dataset_table_name in dataset_cfg.tables.keys():
-            extract_op = create_kaggle_dataset_table_extractor(dataset_table_name, dataset_cfg)
             loader_op = create_kaggle_dataset_table_loader(dataset_table_name, dataset_cfg)
-            tester_op = create_kaggle_dataset_table_tester(dataset_table_name, dataset_cfg)
-            extract_op >> loader_op >> tester_op >> transform_op
+            extract_op >> loader_op
+            loader_op >> tester_op
+            loader_ops[dataset_table_name] = loader_op
+            if dataset_cfg.parquet_export:
+                # The snapshot is written from the same file the table was loaded from, alongside the tests
+                loader_op >> create_kaggle_dataset_table_parquet_exporter(dataset_table_name, dataset_cfg)
+        # Each branch of models runs as soon as its own tables are loaded. Until dbt has written a manifest, all the models run at once
+        branches = model_branches.get(dataset_cfg.name, [])
+        if branches:
+            transform_ops = {}
+            for branch in branches:
+                transform_op = create_dbt_branch_runner(branch)
+                for dataset_table_name in branch.source_tables:
+                    loader_ops[dataset_table_name] >> transform_op
+                for upstream_branch in branch.upstream_branches:
+                    transform_ops[upstream_branch.name] >> transform_op
+                transform_ops[branch.name] = transform_op
+            transform_ops = list(transform_ops.values())
+        else:
+            transform_ops = [create_dbt_runner(dataset_cfg)]
+            list(loader_ops.values()) >> transform_ops[0]
+        if dataset_cfg.parquet_export:
+            # The presentation models are only published once the source tests have passed
+            presentation_exporter_op = create_presentation_parquet_exporter(dataset_cfg)
+            transform_ops >> presentation_exporter_op
+            tester_op >> presentation_exporter_op
     return dag
 
-# Read the configs
-dataset_configs = read_kaggle_dbt_source_configs(dbt_path, dbt_project)
+# Read the configs. They are cached in an index file, so the yml files are only parsed again when they change
+dataset_configs = read_kaggle_dbt_source_configs_cached(dbt_path, dbt_project)
+# Group the models by the source tables they depend on, from the manifest written by the last dbt invocation. Cached like the configs
+model_branches = get_source_model_branches_cached(dbt_path, dbt_project, list(dataset_configs))
 
 # For each one of the configs, build an airflow DAG
 for dbt_dataset_name, dataset_cfg in dataset_configs.items():
-    globals()[dbt_dataset_name] = create_kaggle_elt_dag(dataset_cfg, None, default_args)
\ No newline at end of file
+    globals()[dbt_dataset_name] = create_kaggle_elt_dag(dataset_cfg, dataset_cfg.schedule, default_args)
\ No newline at end of file
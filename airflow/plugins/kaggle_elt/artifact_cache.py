@@ -0,0 +1,139 @@
+import os
+import json
+import fcntl
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+from kaggle_elt.load_manifest import hash_file
+from typing import Any, Dict, Iterator, Optional
+
+DEFAULT_CACHE_DIR = '/tmp/kaggle_cache'
+
+class ArtifactCache:
+    """
+    A class representing a content-addressed cache of downloaded files, shared across tasks & datasets.
+    Each file is stored once per content hash, and referenced by the dataset version it was downloaded from.
+    """
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR):
+        """Constructs all necessary attributes for the object"""
+        self.cache_dir = cache_dir
+
+    def _object_path(self, content_hash: str) -> str:
+        """Returns the path of the file with a given content hash"""
+        return f'{self.cache_dir}/objects/{content_hash[:2]}/{content_hash}'
+
+    def _ref_path(self, dataset: str, version: int, file_name: str) -> str:
+        """Returns the path of the reference from a dataset version's file to its content"""
+        return f'{self.cache_dir}/refs/{dataset}/{version}/{file_name}.json'
+
+    def partial_path(self, dataset: str, version: int, file_name: str) -> str:
+        """Returns the path partial downloads are written to, so they can be resumed by the next attempt"""
+        path = f'{self.cache_dir}/partial/{dataset}/{version}/{file_name}'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    @contextmanager
+    def using_objects(self) -> Iterator[None]:
+        """Holds a shared lock on the stored files, so they aren't evicted while they are looked up, added & placed in a download path"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f'{self.cache_dir}/objects.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def lock(self, dataset: str, version: int, file_name: str) -> Iterator[None]:
+        """Holds an exclusive lock on a dataset version's file, so concurrent tasks don't download it at the same time"""
+        with open(f'{self.partial_path(dataset, version, file_name)}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, dataset: str, version: int, file_name: str) -> Optional[Dict[str, Any]]:
+        """Returns the reference to a dataset version's file, if it's in the cache"""
+        try:
+            with open(self._ref_path(dataset, version, file_name), 'r') as ifile:
+                ref = json.load(ifile)
+        except (OSError, ValueError):
+            return None
+        return ref if os.path.isfile(self._object_path(ref['content_hash'])) else None
+
+    def put(self, dataset: str, version: int, file_name: str, file_path: str, compressed: bool) -> Dict[str, Any]:
+        """Moves a downloaded file into the cache and references it from the dataset version. Returns the reference"""
+        content_hash, _ = hash_file(file_path)
+        object_path = self._object_path(content_hash)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if os.path.isfile(object_path):
+            # Same content as a file of another version or dataset
+            os.remove(file_path)
+        else:
+            os.replace(file_path, object_path)
+        ref = {'content_hash': content_hash, 'compressed': compressed, 'size': os.path.getsize(object_path)}
+        ref_path = self._ref_path(dataset, version, file_name)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(ref_path), delete=False) as ofile:
+            json.dump(ref, ofile)
+        os.replace(ofile.name, ref_path)
+        return ref
+
+    def materialize(self, ref: Dict[str, Any], target_path: str) -> bool:
+        """
+        Places a cached file at the target path, hard linking it if possible to avoid copying it.
+        Returns False if the target path already was the cached file
+        """
+        object_path = self._object_path(ref['content_hash'])
+        if os.path.isfile(target_path) and os.path.samefile(object_path, target_path):
+            return False
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        tmp_path = f'{target_path}.tmp'
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(object_path, tmp_path)
+        except OSError:
+            # The cache lives on a different filesystem
+            shutil.copyfile(object_path, tmp_path)
+        os.replace(tmp_path, target_path)
+        return True
+
+    def evict(self, dataset: str, current_version: int) -> int:
+        """
+        Removes the references & partial downloads of the versions of a dataset older than the current one, and then the files
+        no longer referenced by any dataset version. The files placed in the download paths are hard links, so they are kept.
+        The files are only removed if no other task is using them at the time. Returns the number of bytes freed in the cache
+        """
+        for kind in ('refs', 'partial'):
+            dataset_dir = f'{self.cache_dir}/{kind}/{dataset}'
+            if not os.path.isdir(dataset_dir):
+                continue
+            for version in os.listdir(dataset_dir):
+                if version.isdigit() and int(version) < current_version:
+                    shutil.rmtree(f'{dataset_dir}/{version}', ignore_errors=True)
+        freed = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f'{self.cache_dir}/objects.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Other downloads are running. Their unreferenced files will be removed by the next eviction
+                return freed
+            referenced = set()
+            for dir_path, _, file_names in os.walk(f'{self.cache_dir}/refs'):
+                for file_name in file_names:
+                    try:
+                        with open(os.path.join(dir_path, file_name), 'r') as ifile:
+                            referenced.add(json.load(ifile)['content_hash'])
+                    except (OSError, ValueError, KeyError):
+                        continue
+            for dir_path, _, file_names in os.walk(f'{self.cache_dir}/objects'):
+                for content_hash in file_names:
+                    if content_hash not in referenced:
+                        object_path = os.path.join(dir_path, content_hash)
+                        freed += os.path.getsize(object_path)
+                        os.remove(object_path)
+        return freed
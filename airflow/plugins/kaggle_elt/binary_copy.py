@@ -0,0 +1,201 @@
+import io
+import csv
+import struct
+import datetime
+import itertools
+
+from decimal import Decimal
+from functools import lru_cache
+from kaggle_elt.data_quality import StreamingQualityChecker
+from typing import Callable, Dict, List, Optional
+
+# Signature, flags & header extension length of the postgres binary COPY format
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+NULL_FIELD = struct.pack('!i', -1)
+POSTGRES_EPOCH = datetime.date(2000, 1, 1).toordinal()
+
+_SIZE = struct.Struct('!i')
+_INT2 = struct.Struct('!ih')
+_INT4 = struct.Struct('!ii')
+_INT8 = struct.Struct('!iq')
+_FLOAT4 = struct.Struct('!if')
+_FLOAT8 = struct.Struct('!id')
+_NUMERIC_HEADER = struct.Struct('!hhHH')
+_NUMERIC_NAN = 0xC000
+_NUMERIC_NEG = 0x4000
+
+def _encode_text(value: str) -> bytes:
+    """Encodes a text value as a sized field"""
+    data = value.encode('utf-8')
+    return _SIZE.pack(len(data)) + data
+
+@lru_cache(maxsize=None)
+def _encode_date(value: str) -> bytes:
+    """Encodes an ISO date as days since the postgres epoch. Cached, as dates repeat a lot in the datasets"""
+    return _INT4.pack(4, datetime.date.fromisoformat(value).toordinal() - POSTGRES_EPOCH)
+
+def _encode_bool(value: str) -> bytes:
+    """Encodes a boolean accepting the same literals as postgres' text input, which also takes unambiguous prefixes of them"""
+    literal = value.strip().lower()
+    if literal and ('true'.startswith(literal) or 'yes'.startswith(literal) or literal in ('on', '1')):
+        return _SIZE.pack(1) + b'\x01'
+    if literal and ('false'.startswith(literal) or 'no'.startswith(literal) or literal in ('of', 'off', '0')):
+        return _SIZE.pack(1) + b'\x00'
+    raise ValueError(f'Invalid boolean value: {value}')
+
+def _encode_numeric(value: str) -> bytes:
+    """Encodes a decimal number as a postgres NUMERIC, made of base 10000 digits"""
+    sign, digits, exponent = Decimal(value).as_tuple()
+    if exponent == 'n':
+        data = _NUMERIC_HEADER.pack(0, 0, _NUMERIC_NAN, 0)
+        return _SIZE.pack(len(data)) + data
+    if not isinstance(exponent, int):
+        raise ValueError(f'Unsupported numeric value: {value}')
+    digits_str = ''.join(map(str, digits)) + '0' * max(exponent, 0)
+    dscale = max(-exponent, 0)
+    digits_str = digits_str.rjust(dscale, '0')
+    int_str = digits_str[:len(digits_str) - dscale].lstrip('0')
+    frac_str = digits_str[len(digits_str) - dscale:]
+    # Align the integer part to the left and the fractional part to the right in groups of 4 digits
+    int_str = int_str.rjust(-(-len(int_str) // 4) * 4, '0')
+    frac_str = frac_str.ljust(-(-len(frac_str) // 4) * 4, '0')
+    groups_str = int_str + frac_str
+    groups = [int(groups_str[i:i + 4]) for i in range(0, len(groups_str), 4)]
+    weight = len(int_str) // 4 - 1
+    # Leading & trailing zero groups are not stored
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    data = _NUMERIC_HEADER.pack(len(groups), weight, _NUMERIC_NEG if sign else 0, dscale) + struct.pack(f'!{len(groups)}H', *groups)
+    return _SIZE.pack(len(data)) + data
+
+# Field encoders by postgres type name. Each one turns the text value into a sized binary field
+_ENCODERS = {
+    'VARCHAR': _encode_text,
+    'CHARACTER VARYING': _encode_text,
+    'CHAR': _encode_text,
+    'CHARACTER': _encode_text,
+    'TEXT': _encode_text,
+    'SMALLINT': lambda v: _INT2.pack(2, int(v)),
+    'INT2': lambda v: _INT2.pack(2, int(v)),
+    'INTEGER': lambda v: _INT4.pack(4, int(v)),
+    'INT': lambda v: _INT4.pack(4, int(v)),
+    'INT4': lambda v: _INT4.pack(4, int(v)),
+    'BIGINT': lambda v: _INT8.pack(8, int(v)),
+    'INT8': lambda v: _INT8.pack(8, int(v)),
+    'REAL': lambda v: _FLOAT4.pack(4, float(v)),
+    'FLOAT4': lambda v: _FLOAT4.pack(4, float(v)),
+    'DOUBLE PRECISION': lambda v: _FLOAT8.pack(8, float(v)),
+    'FLOAT8': lambda v: _FLOAT8.pack(8, float(v)),
+    'FLOAT': lambda v: _FLOAT8.pack(8, float(v)),
+    'NUMERIC': _encode_numeric,
+    'DECIMAL': _encode_numeric,
+    'DATE': _encode_date,
+    'BOOLEAN': _encode_bool,
+    'BOOL': _encode_bool,
+}
+
+def get_binary_encoder(data_type: str) -> Callable[[str], bytes]:
+    """Returns the binary field encoder for a given postgres data type. Its modifiers are ignored, except the precision of FLOAT"""
+    type_name = ' '.join(data_type.split('(')[0].upper().split())
+    # FLOAT(1) to FLOAT(24) are stored as REAL
+    if type_name == 'FLOAT' and '(' in data_type and int(data_type.split('(')[1].split(')')[0]) <= 24:
+        type_name = 'REAL'
+    if type_name not in _ENCODERS:
+        raise ValueError(f'Data type {data_type} is not supported by the binary COPY format')
+    return _ENCODERS[type_name]
+
+class BinaryCopyCSVSanitizer(io.RawIOBase):
+    """
+    A class that reads and sanitizes a csv file in an streaming fashion, like the BatchedCSVSanitizer,
+    but encodes the rows into the postgres binary COPY format using the declared type of each column.
+    The columns are emitted in the order of column_types, regardless of their order in the csv file.
+    If a quality checker is provided, it's fed with each batch of rows.
+    """
+    def __init__(
+            self,
+            file,
+            column_name_mapping: Dict[str, str],
+            column_types: Dict[str, str],
+            null_value: str,
+            sep: str=',',
+            quote: str='"',
+            batch_size: int=10000,
+            quality_checker: Optional[StreamingQualityChecker] = None
+        ):
+        """Constructs all necessary attributes for the object"""
+        self._csv_iter = csv.reader(file, delimiter=sep, quotechar=quote)
+        self._quote = quote
+        self._null_value = null_value
+        self._batch_size = batch_size
+        self._encoders = [get_binary_encoder(t) for t in column_types.values()]
+        self._included_idx = self._process_header(column_name_mapping, list(column_types.keys()))
+        self._row_header = struct.pack('!h', len(self._included_idx))
+        self._buffer = PGCOPY_HEADER
+        self._pos = 0
+        self._finished = False
+        self.quality_checker = quality_checker
+        if quality_checker is not None:
+            quality_checker.bind(dict(zip(column_types.keys(), self._included_idx)))
+
+    def _process_header(self, column_name_mapping: Dict[str, str], column_names: List[str]) -> List[int]:
+        """Reads the csv header and returns the index of each one of the output columns"""
+        header_tokens = [column_name_mapping.get(c) for c in next(self._csv_iter)]
+        return [header_tokens.index(c) for c in column_names]
+
+    def _encode_field(self, token: str, encoder: Callable[[str], bytes]) -> bytes:
+        """Sanitizes a token and encodes it as a binary field"""
+        token = token.replace(self._quote, '')
+        return NULL_FIELD if token == self._null_value else encoder(token)
+
+    def _build_binary_block(self, rows: List[List[str]]) -> bytes:
+        """Encodes a batch of rows into a block of binary COPY tuples"""
+        encode_field = self._encode_field
+        fields = list(zip(self._included_idx, self._encoders))
+        block = []
+        for row in rows:
+            # Blank lines carry no tuple. The text COPY would reject them, so don't silently skip them either
+            if not row:
+                raise ValueError('Blank line found in csv file')
+            block.append(self._row_header)
+            block.extend(encode_field(row[i], encoder) for i, encoder in fields)
+        return b''.join(block)
+
+    def _fill_buffer(self) -> None:
+        """Replaces the consumed buffer with the next batch of encoded rows"""
+        rows = list(itertools.islice(self._csv_iter, self._batch_size))
+        if rows and self.quality_checker is not None:
+            self.quality_checker.observe(rows)
+        if rows:
+            self._buffer = self._build_binary_block(rows)
+        elif not self._finished:
+            self._buffer = PGCOPY_TRAILER
+            self._finished = True
+        else:
+            self._buffer = b''
+        self._pos = 0
+
+    def read(self, n: Optional[int] = None) -> bytes:
+        """Reads n bytes from the input"""
+        chunks = []
+        remaining = -1 if n is None or n < 0 else n
+        while remaining != 0:
+            if self._pos >= len(self._buffer):
+                self._fill_buffer()
+                if not self._buffer: break
+            end = len(self._buffer) if remaining < 0 else self._pos + remaining
+            chunk = self._buffer[self._pos:end]
+            self._pos += len(chunk)
+            if remaining > 0:
+                remaining -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def readable(self) -> bool:
+        """Return true to indicate that the object is readable"""
+        return True
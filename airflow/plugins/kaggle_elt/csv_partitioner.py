@@ -0,0 +1,75 @@
+import io
+
+from typing import List, Tuple
+
+class CSVFileRange(io.RawIOBase):
+    """
+    A class that exposes a byte range of a csv file as a file-like object. The csv header is
+    prepended to the range so every partition can be consumed as a standalone csv file.
+    """
+    def __init__(self, file_path: str, start: int, end: int, header: bytes):
+        """Constructs all necessary attributes for the object"""
+        self._file = open(file_path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._header = header
+
+    def readinto(self, b) -> int:
+        """Reads bytes into a pre-allocated buffer, first from the header and then from the file range"""
+        if self._header:
+            n = min(len(b), len(self._header))
+            b[:n] = self._header[:n]
+            self._header = self._header[n:]
+            return n
+        if self._remaining <= 0:
+            return 0
+        data = self._file.read(min(len(b), self._remaining))
+        self._remaining -= len(data)
+        b[:len(data)] = data
+        return len(data)
+
+    def readable(self) -> bool:
+        """Return true to indicate that the object is readable"""
+        return True
+
+    def close(self) -> None:
+        """Closes the underlying file"""
+        self._file.close()
+        super().close()
+
+def read_csv_header(file_path: str) -> bytes:
+    """Reads the raw header line of a csv file"""
+    with open(file_path, 'rb') as ifile:
+        return ifile.readline()
+
+def find_csv_partitions(file_path: str, num_partitions: int, quote: str='"') -> Tuple[bytes, List[Tuple[int, int]]]:
+    """
+    Splits a csv file into roughly equally sized byte ranges that start and end on record boundaries.
+    Newlines inside quoted fields are not considered boundaries. Returns the header and the ranges.
+    Assumes an ASCII-compatible encoding, which holds for all the encodings used by the Kaggle datasets.
+    """
+    quote_byte = quote.encode('ascii')
+    with open(file_path, 'rb') as ifile:
+        file_size = ifile.seek(0, io.SEEK_END)
+        ifile.seek(0)
+        header = ifile.readline()
+        partition_size = max((file_size - len(header)) // max(num_partitions, 1), 1)
+        boundaries = [len(header)]
+        next_boundary = len(header) + partition_size
+        offset = len(header)
+        in_quotes = False
+        for line in ifile:
+            offset += len(line)
+            # A record ends on a newline only if we are not inside a quoted field
+            if line.count(quote_byte) % 2:
+                in_quotes = not in_quotes
+            if not in_quotes and offset >= next_boundary and len(boundaries) < num_partitions:
+                boundaries.append(offset)
+                next_boundary = offset + partition_size
+        boundaries.append(file_size)
+    ranges = [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+    return header, ranges
+
+def open_csv_partition(file_path: str, start: int, end: int, header: bytes, encoding: str) -> io.TextIOBase:
+    """Opens a byte range of a csv file as a text file, with the header prepended"""
+    return io.TextIOWrapper(io.BufferedReader(CSVFileRange(file_path, start, end, header)), encoding=encoding)
@@ -1,6 +1,8 @@
 import io
 import csv
+import itertools
 
+from kaggle_elt.data_quality import StreamingQualityChecker
 from typing import List, Optional, Dict
 
 class CSVSanitizer(io.TextIOBase):
@@ -22,6 +24,7 @@ class CSVSanitizer(io.TextIOBase):
     def _process_header(self, column_name_mapping: Dict[str, str]) -> str:
         """Reads the csv header, sanitizes it and returns the mask of included fields"""
         header_tokens = next(self._csv_iter)
+        self._column_positions = {column_name_mapping[c]: i for i, c in enumerate(header_tokens) if c in column_name_mapping}
         # Initialize the buffer with the sanitized header
         self._buffer += self._build_sanitized_row((column_name_mapping[c] for c in header_tokens if c in column_name_mapping))
         return [col in column_name_mapping for col in header_tokens]
@@ -68,4 +71,74 @@ class CSVSanitizer(io.TextIOBase):
     
     def readable(self) -> bool:
         """Return true to indicate that the object is readable"""
-        return True
\ No newline at end of file
+        return True
+
+class BatchedCSVSanitizer(CSVSanitizer):
+    """
+    A faster variant of the CSVSanitizer that parses and sanitizes rows in batches. Instead of
+    building one string per row it builds one block of text every batch_size rows, using the
+    precomputed indexes of the included columns. Its output is identical to the CSVSanitizer one.
+    If a quality checker is provided, it's fed with each batch of rows.
+    """
+    def __init__(
+            self,
+            file,
+            column_name_mapping: Dict[str, str],
+            sep: str=',',
+            replacement_sep: str='|',
+            quote: str='"',
+            batch_size: int=10000,
+            quality_checker: Optional[StreamingQualityChecker] = None
+        ):
+        """Constructs all necessary attributes for the object"""
+        super().__init__(file, column_name_mapping, sep, replacement_sep, quote)
+        self._batch_size = batch_size
+        self.quality_checker = quality_checker
+        if quality_checker is not None:
+            quality_checker.bind(self._column_positions)
+        self._pos = 0
+        # Indexes of the included fields, used instead of the mask to pick the tokens of each row
+        self._included_idx = [i for i, is_included in enumerate(self._is_field_included) if is_included]
+        self._expected_num_tokens = len(self._is_field_included)
+        # If the replacement separator contains quotes we can't remove them from the whole block at once
+        self._sanitize_per_token = quote in replacement_sep
+
+    def _build_sanitized_block(self, rows: List[List[str]]) -> str:
+        """Concatenates a batch of rows into a block of sanitized rows"""
+        join = self._replacement_sep.join
+        idx = self._included_idx
+        num_tokens = self._expected_num_tokens
+        lines = []
+        for row in rows:
+            if self._sanitize_per_token or len(row) != num_tokens:
+                # Malformed rows (or quotes in the separator) go through the regular path, so they behave exactly the same
+                lines.append(self._build_sanitized_row(self._filter_columns(row))[:-1])
+            else:
+                lines.append(join([row[i] for i in idx]))
+        lines.append('')
+        block = '\n'.join(lines)
+        return block if self._sanitize_per_token else block.replace(self._quote, '')
+
+    def _fill_buffer(self) -> None:
+        """Replaces the consumed buffer with the next batch of sanitized rows"""
+        rows = list(itertools.islice(self._csv_iter, self._batch_size))
+        if rows and self.quality_checker is not None:
+            self.quality_checker.observe(rows)
+        self._buffer = self._build_sanitized_block(rows) if rows else ''
+        self._pos = 0
+
+    def read(self, n: Optional[int] = None) -> str:
+        """Reads n characters from the input"""
+        chunks = []
+        remaining = -1 if n is None or n < 0 else n
+        while remaining != 0:
+            if self._pos >= len(self._buffer):
+                self._fill_buffer()
+                if not self._buffer: break
+            end = len(self._buffer) if remaining < 0 else self._pos + remaining
+            chunk = self._buffer[self._pos:end]
+            self._pos += len(chunk)
+            if remaining > 0:
+                remaining -= len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
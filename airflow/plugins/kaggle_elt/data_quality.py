@@ -0,0 +1,250 @@
+from kaggle_elt.kaggle_dbt_source import KaggleDbtSourceTable
+from kaggle_elt.load_manifest import ELT_SCHEMA
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Results of the checks run while loading each source table. Read by the dbt tests, which skip their full-table scans if they are conclusive
+LOAD_QUALITY_CHECKS_TABLE = f'{ELT_SCHEMA}.load_quality_checks'
+# Bits of the bloom filters per expected value. With 2 hash functions, about 0.1% of the unique values are flagged as possible duplicates
+BLOOM_FILTER_BITS_PER_VALUE = 32
+# Number of values the bloom filters are sized for if the table doesn't have expected_rows
+BLOOM_FILTER_DEFAULT_CAPACITY = 1000000
+# Above this number of possible duplicates they aren't verified against the loaded table, and the dbt test scans it instead
+MAX_DUPLICATE_CANDIDATES = 100000
+# Data types whose csv values are compared as-is with the accepted values. Other types would need to be parsed first
+TEXT_DATA_TYPES = ('VARCHAR', 'CHARACTER VARYING', 'TEXT')
+
+class QualityCheckResult:
+    """
+    A class representing the result of a data quality check on a loaded table. The failures are counted like the matching dbt test does
+    (nulls, distinct invalid values, duplicated values...) and are None if the check was inconclusive
+    """
+    def __init__(self, check_name: str, column_name: str, expected: str, failures: Optional[int]):
+        """Constructs all necessary attributes for the object"""
+        self.check_name = check_name
+        self.column_name = column_name
+        self.expected = expected
+        self.failures = failures
+
+class BloomFilter:
+    """A class representing a bloom filter with 2 hash functions, used to find the possibly repeated values of a column in a single pass"""
+    def __init__(self, capacity: int, bits_per_value: int = BLOOM_FILTER_BITS_PER_VALUE):
+        """Constructs all necessary attributes for the object"""
+        self.num_bits = max(64, capacity * bits_per_value)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, values: Iterable[str]) -> List[str]:
+        """Adds values to the filter. Returns the ones that were possibly added before, which include all the actual repeats"""
+        bits = self.bits
+        num_bits = self.num_bits
+        repeated = []
+        # The built-in hash is randomized per process, so a filter can't be shared across processes
+        for value in values:
+            h = hash(value)
+            p1 = h % num_bits
+            p2 = (h >> 32) % num_bits
+            b1 = 1 << (p1 & 7)
+            b2 = 1 << (p2 & 7)
+            if bits[p1 >> 3] & b1 and bits[p2 >> 3] & b2:
+                repeated.append(value)
+            else:
+                bits[p1 >> 3] |= b1
+                bits[p2 >> 3] |= b2
+        return repeated
+
+class StreamingQualityChecker:
+    """
+    A class that computes the not_null, accepted_values & unique dbt tests of a source table's columns over the csv rows while they are
+    streamed into the db, so the tests don't have to scan the loaded table. It's fed with the batches of parsed rows by the sanitizers
+    """
+    def __init__(
+            self,
+            null_value: str,
+            not_null_columns: Iterable[str] = (),
+            accepted_values: Optional[Dict[str, List[str]]] = None,
+            unique_columns: Iterable[str] = (),
+            capacity: int = BLOOM_FILTER_DEFAULT_CAPACITY,
+            quote: str='"'
+        ):
+        """Constructs all necessary attributes for the object"""
+        self.null_value = null_value
+        self.quote = quote
+        self.num_rows = 0
+        # Set if a row doesn't have all the fields, which makes the column checks inconclusive (and the COPY fail)
+        self.malformed = False
+        self.null_counts = {c: 0 for c in not_null_columns}
+        self.accepted_values = {c: set(str(v) for v in values) for c, values in (accepted_values or {}).items()}
+        self.expected_values = {c: '|'.join(str(v) for v in values) for c, values in (accepted_values or {}).items()}
+        self.invalid_values: Dict[str, Set[str]] = {c: set() for c in self.accepted_values}
+        self.bloom_filters = {c: BloomFilter(capacity) for c in unique_columns}
+        self.duplicate_candidates: Dict[str, Set[str]] = {c: set() for c in self.bloom_filters}
+        self._column_positions: Dict[str, int] = {}
+
+    @classmethod
+    def from_table(cls, table_cfg: KaggleDbtSourceTable, null_value: str, check_uniqueness: bool=True) -> 'StreamingQualityChecker':
+        """
+        Builds a checker for the tests declared on a table's columns. Uniqueness is only checked in a single stream, and not for the columns
+        with a unique index, which enforces it when it's built
+        """
+        return cls(
+            null_value,
+            [c.name for c in table_cfg.columns.values() if c.not_null],
+            {
+                c.name: c.accepted_values for c in table_cfg.columns.values()
+                if c.accepted_values is not None and ' '.join(c.data_type.split('(')[0].upper().split()) in TEXT_DATA_TYPES
+            },
+            [
+                c.name for c in table_cfg.columns.values()
+                if check_uniqueness and c.unique and c.name not in table_cfg.unique_indexed_columns
+            ],
+            table_cfg.expected_rows or BLOOM_FILTER_DEFAULT_CAPACITY
+        )
+
+    def bind(self, column_positions: Dict[str, int]) -> None:
+        """Sets the position of each one of the columns in the csv rows. Called by the sanitizer once it has read the header"""
+        self._column_positions = column_positions
+
+    def _get_column_values(self, rows: List[List[str]], column_name: str) -> List[str]:
+        """Gets the values of a column in a batch of rows, without quotes as they are loaded"""
+        i = self._column_positions[column_name]
+        values = [row[i] for row in rows]
+        if self.quote in ''.join(values):
+            values = [v.replace(self.quote, '') for v in values]
+        return values
+
+    def observe(self, rows: List[List[str]]) -> None:
+        """Updates the checks with a batch of parsed csv rows"""
+        self.num_rows += len(rows)
+        if self.malformed:
+            return
+        try:
+            for column_name in self.null_counts:
+                self.null_counts[column_name] += self._get_column_values(rows, column_name).count(self.null_value)
+            for column_name, accepted_values in self.accepted_values.items():
+                values = set(self._get_column_values(rows, column_name))
+                self.invalid_values[column_name].update(v for v in values if v not in accepted_values and v != self.null_value)
+            for column_name, bloom_filter in self.bloom_filters.items():
+                values = [v for v in self._get_column_values(rows, column_name) if v != self.null_value]
+                self.duplicate_candidates[column_name].update(bloom_filter.add(values))
+        except IndexError:
+            self.malformed = True
+
+    def merge(self, other: 'StreamingQualityChecker') -> None:
+        """Adds up the checks computed over another part of the same file (e.g. by a worker of a partitioned load)"""
+        self.num_rows += other.num_rows
+        self.malformed = self.malformed or other.malformed
+        for column_name, null_count in other.null_counts.items():
+            self.null_counts[column_name] += null_count
+        for column_name, invalid_values in other.invalid_values.items():
+            self.invalid_values[column_name].update(invalid_values)
+        # Repeats across parts can't be found by merging bloom filters, so uniqueness is left to the dbt test
+        for column_name in other.bloom_filters:
+            self.bloom_filters.pop(column_name, None)
+            self.duplicate_candidates.pop(column_name, None)
+
+    def get_results(self, cursor, loaded_table_name: str) -> List[QualityCheckResult]:
+        """
+        Returns the results of the checks. The possible duplicates flagged by the bloom filters are verified against the loaded table,
+        which only needs to look them up instead of grouping the whole column
+        """
+        if self.malformed:
+            return []
+        results = [QualityCheckResult('not_null', c, '', n) for c, n in self.null_counts.items()]
+        results.extend(
+            QualityCheckResult('accepted_values', c, self.expected_values[c], len(v)) for c, v in self.invalid_values.items()
+        )
+        for column_name, candidates in self.duplicate_candidates.items():
+            failures = None
+            if len(candidates) <= MAX_DUPLICATE_CANDIDATES:
+                failures = count_duplicated_values(cursor, loaded_table_name, column_name, candidates) if candidates else 0
+            results.append(QualityCheckResult('unique', column_name, '', failures))
+        return results
+
+def count_duplicated_values(cursor, table_name: str, column_name: str, candidates: Iterable[str]) -> int:
+    """Counts how many of the given values of a column appear more than once in a table"""
+    cursor.execute(
+        f"""SELECT COUNT(*)
+              FROM (SELECT {column_name}
+                      FROM {table_name}
+                     WHERE {column_name}::TEXT = ANY(%s)
+                     GROUP BY 1
+                    HAVING COUNT(*) > 1) AS duplicated_values""",
+        (list(candidates),)
+    )
+    return cursor.fetchone()[0]
+
+def get_table_quality_check_results(
+        table_cfg: KaggleDbtSourceTable,
+        checker: StreamingQualityChecker,
+        cursor,
+        loaded_table_name: str,
+        row_count: int
+    ) -> List[QualityCheckResult]:
+    """Returns the results of the checks of a freshly loaded table, including those that don't depend on the streamed rows"""
+    results = checker.get_results(cursor, loaded_table_name)
+    if table_cfg.expected_rows is not None:
+        results.append(QualityCheckResult('row_count', '', str(table_cfg.expected_rows), int(row_count != table_cfg.expected_rows)))
+    # The unique indexes were built on the loaded table, so its values are unique
+    results.extend(
+        QualityCheckResult('unique', c.name, '', 0)
+        for c in table_cfg.columns.values() if c.unique and c.name in table_cfg.unique_indexed_columns
+    )
+    return results
+
+def create_quality_checks_table(cursor) -> None:
+    """Creates the quality checks table if it doesn't exist"""
+    cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {ELT_SCHEMA};')
+    cursor.execute(
+        f"""CREATE TABLE IF NOT EXISTS {LOAD_QUALITY_CHECKS_TABLE} (
+            table_name VARCHAR(255) NOT NULL,
+            check_name VARCHAR(255) NOT NULL,
+            column_name VARCHAR(255) NOT NULL,
+            expected TEXT NOT NULL,
+            failures BIGINT,
+            checked_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (table_name, check_name, column_name)
+        );"""
+    )
+
+def get_quality_checks(cursor, table_name: str) -> Dict[Tuple[str, str], QualityCheckResult]:
+    """Gets the stored check results of a table, by check & column"""
+    cursor.execute(
+        f"""SELECT check_name, column_name, expected, failures
+              FROM {LOAD_QUALITY_CHECKS_TABLE}
+             WHERE table_name = %s""",
+        (table_name,)
+    )
+    return {(row[0], row[1]): QualityCheckResult(*row) for row in cursor.fetchall()}
+
+def merge_appended_quality_checks(
+        previous: Dict[Tuple[str, str], QualityCheckResult],
+        appended: List[QualityCheckResult]
+    ) -> List[QualityCheckResult]:
+    """
+    Combines the stored results of a table with the ones computed over the rows appended to it. Counts that can't be combined exactly
+    (e.g. invalid values that may be the same in both) are left inconclusive
+    """
+    results = []
+    for result in appended:
+        prev = previous.get((result.check_name, result.column_name))
+        if result.check_name in ('row_count', 'unique'):
+            # These are computed over the whole table
+            failures = result.failures
+        elif prev is None or prev.expected != result.expected or prev.failures is None or result.failures is None:
+            failures = None
+        elif result.check_name == 'accepted_values' and prev.failures and result.failures:
+            # The invalid values of the appended rows may be the same ones
+            failures = None
+        else:
+            failures = prev.failures + result.failures
+        results.append(QualityCheckResult(result.check_name, result.column_name, result.expected, failures))
+    return results
+
+def record_quality_checks(cursor, table_name: str, results: List[QualityCheckResult]) -> None:
+    """Replaces the stored check results of a table. Must be run in the same transaction that makes the load visible"""
+    cursor.execute(f'DELETE FROM {LOAD_QUALITY_CHECKS_TABLE} WHERE table_name = %s', (table_name,))
+    for result in results:
+        cursor.execute(
+            f"""INSERT INTO {LOAD_QUALITY_CHECKS_TABLE} (table_name, check_name, column_name, expected, failures)
+                VALUES (%s, %s, %s, %s, %s)""",
+            (table_name, result.check_name, result.column_name, result.expected, result.failures)
+        )
@@ -0,0 +1,123 @@
+import os
+import json
+import pickle
+import tempfile
+
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+# Index of the model branches of each source, stored in the dbt project's target dir next to the manifest they are built from
+MODEL_BRANCHES_INDEX_PATH = 'target/kaggle_model_branches.pickle'
+
+class DbtModelBranch:
+    """
+    A class representing the models of a dbt project that depend on the same set of source tables. They can be run
+    together as soon as those tables are loaded and the branches of their parent models have run
+    """
+    def __init__(self, source_tables: FrozenSet[str]):
+        """Constructs all necessary attributes for the object"""
+        self.source_tables = source_tables
+        self.models: List[str] = []
+        self.upstream_branches: List['DbtModelBranch'] = []
+
+    @property
+    def name(self) -> str:
+        """Returns a name for the branch, built from its source tables"""
+        return '__'.join(sorted(self.source_tables))
+
+def read_dbt_manifest(dbt_project_path: str, dbt_project_name: str) -> Optional[Dict[str, Any]]:
+    """Reads the manifest dbt writes on every invocation. Returns None if dbt hasn't been run yet"""
+    try:
+        with open(f'{dbt_project_path}/{dbt_project_name}/target/manifest.json', 'r') as ifile:
+            return json.load(ifile)
+    except (OSError, ValueError):
+        return None
+
+def get_source_model_branches(manifest: Dict[str, Any], source_name: str) -> List[DbtModelBranch]:
+    """
+    Groups the models that depend (directly or not) on the tables of a given source by the set of those tables they depend on.
+    Returns the branches in an order in which they can be run
+    """
+    nodes = manifest['nodes']
+    models = {uid: node for uid, node in nodes.items() if node['resource_type'] == 'model'}
+    source_tables = {
+        uid: source['name'] for uid, source in manifest['sources'].items() if source['source_name'] == source_name
+    }
+    upstream_tables: Dict[str, FrozenSet[str]] = {}
+
+    def _get_upstream_tables(uid: str) -> FrozenSet[str]:
+        """Returns the tables of the source a model depends on, following its parent models"""
+        if uid not in upstream_tables:
+            parents = models[uid]['depends_on']['nodes']
+            upstream_tables[uid] = frozenset(
+                {source_tables[p] for p in parents if p in source_tables}
+            ).union(*(_get_upstream_tables(p) for p in parents if p in models))
+        return upstream_tables[uid]
+
+    branches: Dict[FrozenSet[str], DbtModelBranch] = {}
+    model_branches: Dict[str, DbtModelBranch] = {}
+    # A parent model always depends on a subset of its child's tables, so sorting by the number of tables sorts the branches topologically
+    for uid in sorted(models, key=lambda uid: (len(_get_upstream_tables(uid)), uid)):
+        tables = _get_upstream_tables(uid)
+        if not tables:
+            continue
+        branch = branches.setdefault(tables, DbtModelBranch(tables))
+        branch.models.append(models[uid]['name'])
+        model_branches[uid] = branch
+    for uid, branch in model_branches.items():
+        for parent in models[uid]['depends_on']['nodes']:
+            parent_branch = model_branches.get(parent)
+            if parent_branch is not None and parent_branch is not branch and parent_branch not in branch.upstream_branches:
+                branch.upstream_branches.append(parent_branch)
+    return sorted(branches.values(), key=lambda b: (len(b.source_tables), b.name))
+
+def _get_manifest_fingerprint(manifest_path: str) -> Optional[Tuple]:
+    """
+    Builds a fingerprint of the manifest from its size & modification time, or None if it doesn't exist.
+    The parsing code is included too, so the index is rebuilt when it changes
+    """
+    try:
+        return tuple((p, os.stat(p).st_size, os.stat(p).st_mtime_ns) for p in (__file__, manifest_path))
+    except OSError:
+        return None
+
+def get_source_model_branches_cached(
+        dbt_project_path: str,
+        dbt_project_name: str,
+        source_names: List[str],
+        index_path: Optional[str] = None
+    ) -> Dict[str, List[DbtModelBranch]]:
+    """
+    Returns the model branches of each one of the given sources, like get_source_model_branches. They are kept in an index
+    file and only computed again when the manifest changes, so re-parsing the DAG only costs a stat. If the manifest can't be
+    parsed (e.g. dbt is writing it), the branches computed from the last valid one are returned
+    """
+    manifest_path = f'{dbt_project_path}/{dbt_project_name}/target/manifest.json'
+    index_path = index_path or f'{dbt_project_path}/{dbt_project_name}/{MODEL_BRANCHES_INDEX_PATH}'
+    fingerprint = _get_manifest_fingerprint(manifest_path)
+    if fingerprint is None:
+        # dbt hasn't been run yet
+        return {}
+    index = None
+    try:
+        with open(index_path, 'rb') as ifile:
+            index = pickle.load(ifile)
+        if index['fingerprint'] == fingerprint and all(s in index['branches'] for s in source_names):
+            return index['branches']
+    except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError, AttributeError, ImportError):
+        # Missing, corrupted or outdated index. Just rebuild it
+        index = None
+    manifest = read_dbt_manifest(dbt_project_path, dbt_project_name)
+    if manifest is None:
+        print(f'Could not parse the dbt manifest {manifest_path}. Using the model branches of the last valid one')
+        return index['branches'] if index else {}
+    branches = {s: get_source_model_branches(manifest, s) for s in source_names}
+    # Write to a temp file & rename it, so concurrent DAG parses never read a half-written index
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(index_path), delete=False) as ofile:
+            pickle.dump({'fingerprint': fingerprint, 'branches': branches}, ofile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(ofile.name, index_path)
+    except OSError as e:
+        # The branches are still valid, they just won't be cached (e.g. the dbt project is read-only)
+        print(f'Could not write the model branches index to {index_path}: {e}')
+    return branches
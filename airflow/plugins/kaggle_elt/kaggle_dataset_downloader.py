@@ -1,39 +1,192 @@
-import zipfile
 import os
+import shutil
+import zipfile
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from kaggle_elt.artifact_cache import ArtifactCache, DEFAULT_CACHE_DIR
+from kaggle_elt.stage_metrics import StageMetricsRecorder
+from typing import Any, Dict, List, Optional
+
+# Can be pointed to a local stand-in server to run the downloads offline
+KAGGLE_API_URL = os.environ.get('KAGGLE_API_URL', 'https://www.kaggle.com/api/v1')
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+ZIP_MAGIC = b'PK\x03\x04'
+
+class KaggleApiClient:
+    """
+    A class representing a minimal client for the Kaggle datasets API. The credentials belong to the client instead of being
+    read from env variables, so concurrent downloads in the same process can't race on them
+    """
+    def __init__(self, kaggle_api_username: str, kaggle_api_key: str, api_url: str = KAGGLE_API_URL, timeout: float=60):
+        """Constructs all necessary attributes for the object"""
+        self.auth = (kaggle_api_username, kaggle_api_key)
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+
+    def get_dataset_version(self, dataset: str) -> int:
+        """Returns the current version number of a dataset"""
+        response = requests.get(f'{self.api_url}/datasets/view/{dataset}', auth=self.auth, timeout=self.timeout)
+        response.raise_for_status()
+        return int(response.json()['currentVersionNumber'])
+
+    def download_file(self, dataset: str, file: str, version: int, file_path: str) -> int:
+        """
+        Downloads a file of a given dataset version. If the file path already has part of the file the download is resumed
+        from where it was left. Raises an IOError if the connection is dropped before the whole file is received, keeping what
+        was received so the next attempt resumes it. Returns the number of bytes transferred
+        """
+        offset = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        url = f'{self.api_url}/datasets/download/{dataset}/{file}'
+        params = {'datasetVersionNumber': version}
+        with requests.get(url, params=params, headers=headers, auth=self.auth, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # The partial file doesn't match the remote one anymore. Start over
+                os.remove(file_path)
+                return self.download_file(dataset, file, version, file_path)
+            response.raise_for_status()
+            # Servers that don't support ranges send the whole file
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            expected_size = _get_expected_file_size(response)
+            transferred = 0
+            with open(file_path, mode) as ofile:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    ofile.write(chunk)
+                    transferred += len(chunk)
+        # The stream just ends if the connection is dropped, so check that the whole file was received
+        file_size = os.path.getsize(file_path)
+        if expected_size is not None and file_size != expected_size:
+            if file_size > expected_size:
+                # Can't be resumed, start over next time
+                os.remove(file_path)
+            raise IOError(f'Incomplete download of {file} from {dataset} version {version}: {file_size} of {expected_size} bytes received')
+        return transferred
+
+def _get_expected_file_size(response: requests.Response) -> Optional[int]:
+    """Returns the size of the whole file being downloaded, from the Content-Range or Content-Length headers, if known"""
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        # The length is the one of the encoded content, while requests writes it decoded
+        return None
+    if response.status_code == 206:
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+def _is_zip_file(file_path: str) -> bool:
+    """Returns whether a file is a zip file. Kaggle doesn't compress small files"""
+    with open(file_path, 'rb') as ifile:
+        return ifile.read(len(ZIP_MAGIC)) == ZIP_MAGIC
+
+def _extract_file(zipped_file_path: str, file: str, download_path: str) -> int:
+    """Extracts a file from a zip file through a temp file, so a crash never leaves a half-extracted file behind. Returns its size"""
+    with zipfile.ZipFile(zipped_file_path, 'r') as zipped_file:
+        members = zipped_file.namelist()
+        member = file if file in members else members[0]
+        tmp_path = f'{download_path}/{file}.tmp'
+        with zipped_file.open(member, 'r') as ifile, open(tmp_path, 'wb') as ofile:
+            shutil.copyfileobj(ifile, ofile, DOWNLOAD_CHUNK_SIZE)
+        os.replace(tmp_path, f'{download_path}/{file}')
+        return zipped_file.getinfo(member).file_size
+
+def download_kaggle_file_with_client(
+        client: KaggleApiClient,
+        dataset: str,
+        file: str,
+        version: int,
+        download_path: str,
+        force: bool=False,
+        quiet: bool=False,
+        unzip: bool=True,
+        cache: Optional[ArtifactCache] = None
+    ) -> List[Dict[str, Any]]:
+    """
+    Downloads a file of a given dataset version into the artifact cache, unless it's already there, and places it in the download path.
+    Returns the metrics of the download & unzip stages
+    """
+    cache = cache or ArtifactCache()
+    metrics = StageMetricsRecorder(file)
+    with cache.using_objects():
+        with metrics.stage('download') as download_metrics, cache.lock(dataset, version, file):
+            ref = None if force else cache.get(dataset, version, file)
+            if ref is None:
+                partial_path = cache.partial_path(dataset, version, file)
+                if force and os.path.isfile(partial_path):
+                    os.remove(partial_path)
+                if not quiet:
+                    resumed = os.path.isfile(partial_path)
+                    print(f'Download Kaggle File: {"Resuming" if resumed else "Attempting"} download of {file} from {dataset} version {version}')
+                download_metrics.bytes_read = client.download_file(dataset, file, version, partial_path)
+                # Never cache a corrupted archive, as it would be reused by every later run
+                if _is_zip_file(partial_path) and not zipfile.is_zipfile(partial_path):
+                    os.remove(partial_path)
+                    raise IOError(f'Downloaded file {file} from {dataset} version {version} is not a valid zip file')
+                ref = cache.put(dataset, version, file, partial_path, _is_zip_file(partial_path))
+            elif not quiet:
+                print(f'Download Kaggle File: File {file} from {dataset} version {version} found in the artifact cache. Skipping download')
+        # The zip file is kept next to the extracted one, so we can tell if the latter is up to date
+        zipped_file_path = f'{download_path}/{file}.zip' if ref['compressed'] else f'{download_path}/{file}'
+        changed = cache.materialize(ref, zipped_file_path)
+    if unzip and ref['compressed'] and (changed or force or not os.path.isfile(f'{download_path}/{file}')):
+        with metrics.stage('unzip') as unzip_metrics:
+            unzip_metrics.bytes_read = _extract_file(zipped_file_path, file, download_path)
+    return metrics.to_dicts()
+
+def evict_stale_versions(cache: ArtifactCache, dataset: str, version: int, quiet: bool=False) -> None:
+    """Removes the files of the older versions of a dataset from the artifact cache, once the current one has been downloaded"""
+    freed = cache.evict(dataset, version)
+    if not quiet:
+        print(f'Download Kaggle File: Evicted {freed:,} bytes of older versions of {dataset} from the artifact cache')
 
 def download_kaggle_file_with_credentials(
-        dataset: str, 
+        dataset: str,
         file: str,
         kaggle_api_username: str,
         kaggle_api_key: str,
         download_path: str,
         force: bool=False,
         quiet: bool=False,
-        unzip: bool=True
-    ) -> None:
-    """Downloads the specified file from the specified dataset using the provided kaggle credentials"""
-    # If we want to avoid re-downloading when unzipping we need to check for the uncompressed files, as dataset_download_file
-    # only does so for the compressed one.
-    if not force and unzip:
-        if os.path.isfile(f'{download_path}/{file}'):
-            print(f'Download Kaggle File: File {file} already exists at the download location. Skipping download')
-            return
-    # Inject environment variables with the kaggle authentication in order to be able to authenticate.
-    # They are inside of the operator's scope, so they shouldn't leak outside.
-    os.environ['KAGGLE_USERNAME'] = kaggle_api_username
-    os.environ['KAGGLE_KEY'] = kaggle_api_key
-    download_kaggle_file(dataset, file, download_path, force, quiet)
-    # Unzip the file if necessary
-    if unzip:
-        zipped_file_path = f'{download_path}/{file}.zip'
-        with zipfile.ZipFile(zipped_file_path, 'r') as zipped_file:
-            zipped_file.extractall(download_path)
-        os.remove(zipped_file_path)
-
-def download_kaggle_file(dataset: str, file: str, download_path: str, force: bool, quiet: bool) -> None:
-    """Downloads the specified file from the specified dataset. Assumes that valid credentials are available as env variables"""
-    # We need to import the Kaggle api here because for some reason it tries to authenticate as soon as you import the
-    # package (https://github.com/Kaggle/kaggle-api/blob/master/kaggle/__init__.py) and will crash the DAG parse if we
-    # import it on the file header
-    import kaggle
-    kaggle.api.dataset_download_file(dataset, file, download_path, force, quiet)
\ No newline at end of file
+        unzip: bool=True,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        api_url: str = KAGGLE_API_URL
+    ) -> List[Dict[str, Any]]:
+    """
+    Downloads the specified file from the latest version of the specified dataset using the provided kaggle credentials.
+    Returns the metrics of the download & unzip stages, which Airflow pushes to XCom
+    """
+    client = KaggleApiClient(kaggle_api_username, kaggle_api_key, api_url)
+    version = client.get_dataset_version(dataset)
+    cache = ArtifactCache(cache_dir)
+    metrics = download_kaggle_file_with_client(client, dataset, file, version, download_path, force, quiet, unzip, cache)
+    evict_stale_versions(cache, dataset, version, quiet)
+    return metrics
+
+def download_kaggle_files_with_credentials(
+        dataset: str,
+        files: List[str],
+        kaggle_api_username: str,
+        kaggle_api_key: str,
+        download_path: str,
+        force: bool=False,
+        quiet: bool=False,
+        unzip: bool=True,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        api_url: str = KAGGLE_API_URL,
+        max_workers: int=4
+    ) -> List[Dict[str, Any]]:
+    """
+    Downloads several files of the latest version of a dataset concurrently, using a bounded pool of threads.
+    All files are taken from the same version. Returns the metrics of the download & unzip stages of all the files
+    """
+    client = KaggleApiClient(kaggle_api_username, kaggle_api_key, api_url)
+    version = client.get_dataset_version(dataset)
+    cache = ArtifactCache(cache_dir)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_kaggle_file_with_client, client, dataset, file, version, download_path, force, quiet, unzip, cache)
+            for file in files
+        ]
+        metrics = [m for future in futures for m in future.result()]
+    evict_stale_versions(cache, dataset, version, quiet)
+    return metrics
@@ -1,41 +1,177 @@
+import io
+import os
+import time
+import zipfile
 import psycopg2
 
-from kaggle_elt.kaggle_dbt_source import KaggleDbtSource
-from kaggle_elt.csv_sanitizer import CSVSanitizer
-from typing import List
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from kaggle_elt.kaggle_dbt_source import KaggleDbtSource, KaggleDbtSourceTableIndex
+from kaggle_elt.csv_sanitizer import BatchedCSVSanitizer
+from kaggle_elt.binary_copy import BinaryCopyCSVSanitizer
+from kaggle_elt.data_quality import (
+    StreamingQualityChecker, create_quality_checks_table, get_quality_checks, get_table_quality_check_results,
+    merge_appended_quality_checks, record_quality_checks
+)
+from kaggle_elt.csv_partitioner import find_csv_partitions, open_csv_partition, read_csv_header
+from kaggle_elt.load_manifest import LoadManifestEntry, create_load_manifest, get_load_manifest_entry, upsert_load_manifest_entry, hash_file
+from kaggle_elt.partition_tracker import create_partition_tracking_tables, record_changed_partitions
+from kaggle_elt.stage_metrics import StageMetrics, StageMetricsRecorder, TimedReader, create_stage_metrics_table, get_peak_rss, insert_stage_metrics
+from typing import List, Dict, Any, Tuple, Optional, Iterator, Callable
+
+# Size of the blocks handed to copy_expert. Bigger blocks mean less round trips between the sanitizer and psycopg2
+COPY_BUFFER_SIZE = 1024 * 1024
+# Memory available to each index build. Several indexes can be built at the same time
+INDEX_MAINTENANCE_WORK_MEM = '256MB'
 
 class KaggleDbtTableLoader:
     """Class representing a table to be loaded into the db from a csv file, as described in the dbt source metadata"""
-    def __init__(self, kaggle_dbt_source_cfg: KaggleDbtSource, target_table: str, download_dir: str):
+    def __init__(self, kaggle_dbt_source_cfg: KaggleDbtSource, target_table: str, download_dir: str, from_zip: bool=False):
         """Constructs all necessary attributes for the object"""
         self.source_cfg = kaggle_dbt_source_cfg
         self.target_table = kaggle_dbt_source_cfg.get_table(target_table)
         self.download_dir = download_dir
-    
+        # Kaggle doesn't compress small files, so only stream from the zip file if there is one
+        self.from_zip = from_zip and os.path.isfile(self.zip_file_path)
+        self.metrics = StageMetricsRecorder(self.target_table.qualified_name)
+        # Data quality checks computed over the loaded rows, set by the load methods
+        self.quality_checker: Optional[StreamingQualityChecker] = None
+
+    @property
+    def csv_file_path(self) -> str:
+        """Returns the path of the uncompressed csv file"""
+        return f'{self.source_cfg.get_download_path(self.download_dir)}/{self.target_table.kaggle_file_name}'
+
+    @property
+    def zip_file_path(self) -> str:
+        """Returns the path of the csv file compressed as downloaded from Kaggle"""
+        return f'{self.csv_file_path}.zip'
+
+    @property
+    def file_path(self) -> str:
+        """Returns the path of the file the data is loaded from"""
+        return self.zip_file_path if self.from_zip else self.csv_file_path
+
+    @contextmanager
+    def open_csv(self) -> Iterator[io.TextIOBase]:
+        """Opens the csv file as text. If loading from the zip file the csv is decompressed on the fly, without touching the disk"""
+        if not self.from_zip:
+            with open(self.csv_file_path, 'r', encoding=self.source_cfg.encoding) as ifile:
+                yield ifile
+            return
+        with zipfile.ZipFile(self.zip_file_path, 'r') as zipped_file:
+            members = zipped_file.namelist()
+            member = self.target_table.kaggle_file_name if self.target_table.kaggle_file_name in members else members[0]
+            with zipped_file.open(member, 'r') as compressed_file:
+                yield io.TextIOWrapper(compressed_file, encoding=self.source_cfg.encoding)
+
+    @property
+    def shadow_table_name(self) -> str:
+        """Returns the name of the table the data is loaded into before being swapped with the target table"""
+        return f'{self.target_table.name}__shadow'
+
+    @property
+    def qualified_shadow_table_name(self) -> str:
+        """Returns the qualified name of the shadow table"""
+        return f'{self.target_table.schema}.{self.shadow_table_name}'
+
     def _get_table_columns_repr(self, include_types: bool=False) -> List[str]:
         """Gets the name and optionally the type of each one of the columns in the table"""
         return (c.name + (f' {c.data_type}' if include_types else '') for c in self.target_table.columns.values())
 
-    def _build_create_table_stmt(self) -> str:
+    def _build_create_table_stmt(self, qualified_name: str, unlogged: bool=False) -> str:
         """Builds a CREATE TABLE statement from the available dbt source metadata"""
         column_reprs = self._get_table_columns_repr(include_types=True)
-        return f"CREATE TABLE IF NOT EXISTS {self.target_table.qualified_name} ({','.join(column_reprs)});"
-    
-    def _build_copy_stmt(self) -> str:
+        return f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE IF NOT EXISTS {qualified_name} ({','.join(column_reprs)});"
+
+    def _build_copy_stmt(self, qualified_name: str) -> str:
         """Builds a COPY statement from the available dbt source metadata"""
         column_reprs = self._get_table_columns_repr()
-        return f"""COPY {self.target_table.qualified_name} ({','.join(column_reprs)}) FROM STDIN WITH
+        if self.target_table.copy_format == 'binary':
+            return f"COPY {qualified_name} ({','.join(column_reprs)}) FROM STDIN WITH (FORMAT binary);"
+        return f"""COPY {qualified_name} ({','.join(column_reprs)}) FROM STDIN WITH
             CSV
             HEADER
             DELIMITER AS '{self.source_cfg.delimiter}'
             NULL AS '{self.source_cfg.null_value}';
         """
-    
-    def drop_table(self, cursor) -> None:
-        """Drops the table from the db"""
-        print(f'Attempting to drop table {self.target_table.qualified_name}...')
-        cursor.execute(f'DROP TABLE IF EXISTS {self.target_table.qualified_name} CASCADE')
-        print(f'Done')
+
+    def _get_index_name(self, table_name: str, index: KaggleDbtSourceTableIndex) -> str:
+        """Builds the name of an index of the target or shadow table"""
+        return f'{table_name}_{index.name_suffix}'
+
+    def _build_create_index_stmt(self, table_name: str, index: KaggleDbtSourceTableIndex) -> str:
+        """Builds a CREATE INDEX statement for an index of the target or shadow table"""
+        return (
+            f"CREATE {'UNIQUE ' if index.unique else ''}INDEX {self._get_index_name(table_name, index)} "
+            f"ON {self.target_table.schema}.{table_name} USING {index.method} ({','.join(index.columns)});"
+        )
+
+    def _get_indexes(self) -> List[KaggleDbtSourceTableIndex]:
+        """Gets all the indexes to be built on the table, including the ones backing the primary key & the clustering"""
+        indexes = list(self.target_table.indexes)
+        if self.target_table.primary_key_index:
+            indexes.append(self.target_table.primary_key_index)
+        cluster_by = self.target_table.cluster_by
+        if cluster_by and not any(i.columns == cluster_by and i.method == 'btree' for i in indexes):
+            indexes.append(KaggleDbtSourceTableIndex(cluster_by))
+        return indexes
+
+    def _get_sanitizer_factory(self, quality_checker: Optional[StreamingQualityChecker] = None) -> Callable[[io.TextIOBase], io.IOBase]:
+        """Returns a (picklable) callable that wraps a csv file into the sanitizer matching the COPY format"""
+        mapping = self.target_table.get_kaggle_to_dbt_mapping()
+        if self.target_table.copy_format == 'binary':
+            column_types = {c.name: c.data_type for c in self.target_table.columns.values()}
+            return partial(
+                BinaryCopyCSVSanitizer,
+                column_name_mapping=mapping,
+                column_types=column_types,
+                null_value=self.source_cfg.null_value,
+                quality_checker=quality_checker
+            )
+        return partial(BatchedCSVSanitizer, column_name_mapping=mapping, quality_checker=quality_checker)
+
+    def _build_quality_checker(self, check_uniqueness: bool=True) -> StreamingQualityChecker:
+        """Builds a checker for the dbt tests declared on the table's columns, to be fed by the sanitizer"""
+        return StreamingQualityChecker.from_table(self.target_table, self.source_cfg.null_value, check_uniqueness)
+
+    def _add_sanitize_metrics(self, copy_metrics: StageMetrics, sanitize_time: float) -> None:
+        """Records the time spent sanitizing the data during a COPY as a stage of its own"""
+        self.metrics.add(StageMetrics('sanitize', sanitize_time, copy_metrics.bytes_read, copy_metrics.rows_emitted, copy_metrics.peak_rss))
+
+    def _get_dependent_views(self, cursor) -> List[Tuple[str, str]]:
+        """Gets the qualified name & definition of the views that depend (directly or not) on the target table, in creation order"""
+        cursor.execute(
+            """
+            WITH RECURSIVE dependent_views AS (
+                SELECT %s::regclass::oid AS oid, 0 AS depth
+                 UNION ALL
+                SELECT v.oid, dv.depth + 1
+                  FROM dependent_views AS dv
+                    INNER JOIN pg_depend AS d
+                        ON d.refobjid = dv.oid
+                       AND d.classid = 'pg_rewrite'::regclass
+                    INNER JOIN pg_rewrite AS r
+                        ON r.oid = d.objid
+                    INNER JOIN pg_class AS v
+                        ON v.oid = r.ev_class
+                       AND v.oid <> dv.oid
+                       AND v.relkind = 'v'
+            )
+            SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname), pg_get_viewdef(c.oid)
+              FROM dependent_views AS dv
+                INNER JOIN pg_class AS c
+                    ON c.oid = dv.oid
+                INNER JOIN pg_namespace AS n
+                    ON n.oid = c.relnamespace
+             WHERE dv.depth > 0
+             GROUP BY n.nspname, c.relname, c.oid
+             ORDER BY MAX(dv.depth)
+            """,
+            (self.target_table.qualified_name,)
+        )
+        return cursor.fetchall()
 
     def create_schema(self, cursor) -> None:
         """Creates the table's schema"""
@@ -44,45 +180,370 @@ class KaggleDbtTableLoader:
         cursor.execute(create_schema_stmt)
         print(f'Done')
 
-    def create_table(self, cursor) -> None:
-        """Create the table into the db using the available metadata"""
-        print(f'Attempting to create table {self.target_table.qualified_name}...')
-        create_table_stmt = self._build_create_table_stmt()
-        cursor.execute(create_table_stmt)
+    def create_shadow_table(self, cursor) -> None:
+        """Creates an empty, unlogged and index-less shadow table with the same definition as the target table"""
+        print(f'Attempting to create shadow table {self.qualified_shadow_table_name}...')
+        self.drop_shadow_table(cursor)
+        cursor.execute(self._build_create_table_stmt(self.qualified_shadow_table_name, unlogged=True))
         print(f'Done')
 
-    def load_data_from_csv(self, cursor):
-        """Loads the table into the db from the CSV file"""
-        print(f'Attempting to load data from csv into table {self.target_table.qualified_name}...')
-        copy_stmt = self._build_copy_stmt()
-        file_path = f'{self.download_dir}/{self.source_cfg.name}/{self.target_table.kaggle_file_name}'
-        with open(file_path, 'r', encoding=self.source_cfg.encoding) as ifile:
+    def load_data_from_csv(self, cursor) -> int:
+        """Loads the shadow table from the CSV file. Returns the number of loaded rows"""
+        print(f'Attempting to load data from csv into table {self.qualified_shadow_table_name}...')
+        copy_stmt = self._build_copy_stmt(self.qualified_shadow_table_name)
+        self.quality_checker = self._build_quality_checker()
+        with self.metrics.stage('copy') as copy_metrics, self.open_csv() as ifile:
             # Use the CSVSanitizer as an streaming adapter between the csv file and the copy_expert method
-            cursor.copy_expert(copy_stmt, CSVSanitizer(ifile, self.target_table.get_kaggle_to_dbt_mapping()))
+            sanitizer = self._get_sanitizer_factory(self.quality_checker)(ifile)
+            copy_metrics.rows_emitted, sanitize_time = copy_from_sanitizer(cursor, copy_stmt, sanitizer)
+            copy_metrics.bytes_read = os.path.getsize(self.file_path)
+        self._add_sanitize_metrics(copy_metrics, sanitize_time)
+        print(f'Done')
+        return copy_metrics.rows_emitted
+
+    def load_data_from_csv_partitioned(self, pg_conn_kwargs: Dict[str, Any]) -> int:
+        """Loads the shadow table from the CSV file, splitting it in partitions that are loaded in parallel. Returns the number of loaded rows"""
+        num_workers = self.target_table.load_workers
+        print(f'Attempting to load data from csv into table {self.qualified_shadow_table_name} with {num_workers} workers...')
+        header, partitions = find_csv_partitions(self.file_path, num_workers)
+        copy_stmt = self._build_copy_stmt(self.qualified_shadow_table_name)
+        # Each worker checks its own partition. Repeated values across partitions can't be found that way, so uniqueness isn't checked
+        self.quality_checker = self._build_quality_checker(check_uniqueness=False)
+        sanitizer_factory = self._get_sanitizer_factory(self._build_quality_checker(check_uniqueness=False))
+        with self.metrics.stage('copy') as copy_metrics, ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(
+                    _load_csv_partition, pg_conn_kwargs, copy_stmt, self.file_path, start, end, header, self.source_cfg.encoding, sanitizer_factory
+                )
+                for start, end in partitions
+            ]
+            # Surface the first error, if any. The shadow table is discarded by the caller
+            results = [future.result() for future in futures]
+            copy_metrics.rows_emitted = sum(num_rows for num_rows, _, _, _ in results)
+            copy_metrics.bytes_read = os.path.getsize(self.file_path)
+            # The workers are spawned for this stage, so their peak RSS is the one of the stage
+            copy_metrics.peak_rss = max(peak_rss for _, _, _, peak_rss in results)
+        for _, _, quality_checker, _ in results:
+            self.quality_checker.merge(quality_checker)
+        # The sanitize time is added up across workers, so it can exceed the wall time of the copy
+        self._add_sanitize_metrics(copy_metrics, sum(sanitize_time for _, sanitize_time, _, _ in results))
+        print(f'Done')
+        return copy_metrics.rows_emitted
+
+    def append_data_from_csv(self, cursor, start: int) -> int:
+        """Appends the rows of the CSV file starting at a given byte offset into the target table. Returns the number of loaded rows"""
+        print(f'Attempting to append data from csv into table {self.target_table.qualified_name} from byte {start}...')
+        copy_stmt = self._build_copy_stmt(self.target_table.qualified_name)
+        header = read_csv_header(self.file_path)
+        end = os.path.getsize(self.file_path)
+        # Repeats of the previously loaded values can't be found in the appended rows alone, so uniqueness isn't checked
+        self.quality_checker = self._build_quality_checker(check_uniqueness=False)
+        with self.metrics.stage('copy') as copy_metrics, open_csv_partition(self.file_path, start, end, header, self.source_cfg.encoding) as ifile:
+            sanitizer = self._get_sanitizer_factory(self.quality_checker)(ifile)
+            copy_metrics.rows_emitted, sanitize_time = copy_from_sanitizer(cursor, copy_stmt, sanitizer)
+            copy_metrics.bytes_read = end - start
+        self._add_sanitize_metrics(copy_metrics, sanitize_time)
+        print(f'Done')
+        return copy_metrics.rows_emitted
+
+    def build_shadow_table_indexes(self, cursor, pg_conn_kwargs: Dict[str, Any]) -> None:
+        """
+        Builds the indexes, primary key & clustering declared in the table's meta on the loaded shadow table, which is much
+        faster than maintaining them during the COPY. CREATE INDEX doesn't block other index builds on the same table,
+        so the indexes are built in parallel, each one by its own connection.
+        """
+        indexes = self._get_indexes()
+        if not indexes:
+            return
+        print(f'Attempting to build {len(indexes)} indexes on table {self.qualified_shadow_table_name}...')
+        with self.metrics.stage('index'):
+            # CLUSTER rewrites the table together with its indexes, so it's done before building the rest of them
+            cluster_index = next((i for i in indexes if i.columns == self.target_table.cluster_by and i.method == 'btree'), None)
+            if cluster_index:
+                cursor.execute(self._build_create_index_stmt(self.shadow_table_name, cluster_index))
+                cursor.execute(f'CLUSTER {self.qualified_shadow_table_name} USING {self._get_index_name(self.shadow_table_name, cluster_index)}')
+            create_index_stmts = [self._build_create_index_stmt(self.shadow_table_name, i) for i in indexes if i is not cluster_index]
+            with ThreadPoolExecutor(max_workers=max(1, min(self.target_table.index_workers, len(create_index_stmts)))) as executor:
+                # Surface the first error, if any. The shadow table is discarded by the caller
+                for future in [executor.submit(_execute_maintenance_stmt, pg_conn_kwargs, stmt) for stmt in create_index_stmts]:
+                    future.result()
+            primary_key_index = self.target_table.primary_key_index
+            if primary_key_index:
+                primary_key_name = self._get_index_name(self.shadow_table_name, primary_key_index)
+                cursor.execute(f'ALTER TABLE {self.qualified_shadow_table_name} ADD CONSTRAINT {primary_key_name} PRIMARY KEY USING INDEX {primary_key_name}')
+        print(f'Done')
+
+    def track_changed_partitions(self, cursor, loaded_table_name: str) -> None:
+        """Records which partitions of the table changed with this load, if the table has a partition key"""
+        if not self.target_table.partition_key:
+            return
+        print(f'Attempting to find the changed partitions of table {self.target_table.qualified_name}...')
+        with self.metrics.stage('track_partitions'):
+            changed_partitions = record_changed_partitions(cursor, self.target_table.qualified_name, loaded_table_name, self.target_table.partition_key)
+        print(f'Done. Changed partitions: {", ".join(changed_partitions) or "none"}')
+
+    def store_quality_checks(self, cursor, loaded_table_name: str, row_count: int, append: bool=False) -> None:
+        """
+        Stores the results of the data quality checks computed while loading the table, so the dbt tests can skip their scans.
+        If rows were appended, the results are combined with the stored ones
+        """
+        print(f'Attempting to store the data quality checks of table {self.target_table.qualified_name}...')
+        with self.metrics.stage('quality_checks'):
+            results = get_table_quality_check_results(self.target_table, self.quality_checker, cursor, loaded_table_name, row_count)
+            if append:
+                results = merge_appended_quality_checks(get_quality_checks(cursor, self.target_table.qualified_name), results)
+            record_quality_checks(cursor, self.target_table.qualified_name, results)
+        failed_checks = [f'{r.check_name}({r.column_name})' for r in results if r.failures]
+        print(f'Done. Failed checks: {", ".join(failed_checks) or "none"}')
+
+    def set_shadow_table_logged(self, cursor) -> None:
+        """Turns the shadow table into a regular, crash-safe table"""
+        print(f'Attempting to set table {self.qualified_shadow_table_name} as logged...')
+        with self.metrics.stage('set_logged'):
+            cursor.execute(f'ALTER TABLE {self.qualified_shadow_table_name} SET LOGGED')
+        print(f'Done')
+
+    def analyze_shadow_table(self, cursor) -> None:
+        """Collects the planner statistics of the shadow table, so it's ready to be queried as soon as it's swapped in"""
+        print(f'Attempting to analyze table {self.qualified_shadow_table_name}...')
+        with self.metrics.stage('analyze'):
+            cursor.execute(f'ANALYZE {self.qualified_shadow_table_name}')
+        print(f'Done')
+
+    def swap_shadow_table(self, cursor) -> None:
+        """
+        Replaces the target table with the shadow table. Must be run inside a transaction so readers see either
+        the old or the new table. The views depending on the target table are re-created on top of the new one.
+        """
+        print(f'Attempting to swap {self.qualified_shadow_table_name} with {self.target_table.qualified_name}...')
+        with self.metrics.stage('swap'):
+            cursor.execute('SELECT to_regclass(%s)', (self.target_table.qualified_name,))
+            dependent_views = self._get_dependent_views(cursor) if cursor.fetchone()[0] else []
+            cursor.execute(f'DROP TABLE IF EXISTS {self.target_table.qualified_name} CASCADE')
+            cursor.execute(f'ALTER TABLE {self.qualified_shadow_table_name} RENAME TO {self.target_table.name}')
+            # Index names are unique per schema, so they have to follow the table for the next load's shadow table to reuse them
+            for index in self._get_indexes():
+                cursor.execute(
+                    f'ALTER INDEX IF EXISTS {self.target_table.schema}.{self._get_index_name(self.shadow_table_name, index)} '
+                    f'RENAME TO {self._get_index_name(self.target_table.name, index)}'
+                )
+            for view_name, view_definition in dependent_views:
+                cursor.execute(f'CREATE VIEW {view_name} AS {view_definition}')
         print(f'Done')
 
-def load_csv_to_postgres(pg_creds, kaggle_dbt_source_cfg: KaggleDbtSource, target_table: str, download_dir: str = '/tmp'):
-    """Creates the db connection and runs the DB management methods"""
+    def drop_shadow_table(self, cursor) -> None:
+        """Drops the shadow table from the db"""
+        cursor.execute(f'DROP TABLE IF EXISTS {self.qualified_shadow_table_name}')
+
+    def plan_load(self, cursor, previous_load: Optional[LoadManifestEntry]) -> Tuple[str, LoadManifestEntry]:
+        """
+        Compares the CSV file & the table's definition with the ones from the previous load and decides how to load it: 'skip' if
+        both are unchanged, 'append' if rows have only been added at the end of the file (and the table is configured for it) or
+        'full' otherwise. Returns the load type and the manifest entry describing the current file.
+        """
+        file_stat = os.stat(self.file_path)
+        current_load = LoadManifestEntry(
+            self.target_table.qualified_name, file_stat.st_size, file_stat.st_mtime, None, 0, 0.0,
+            self.source_cfg.get_table_load_fingerprint(self.target_table.name)
+        )
+        cursor.execute('SELECT to_regclass(%s)', (self.target_table.qualified_name,))
+        if (
+            previous_load is None
+            or cursor.fetchone()[0] is None
+            # The table was loaded with a different definition, which is only applied by a full load
+            or current_load.config_fingerprint != previous_load.config_fingerprint
+            or self._is_truncated_by_crash(cursor, previous_load)
+        ):
+            current_load.content_hash, _ = hash_file(self.file_path)
+            return 'full', current_load
+        # Same size & modification time, we assume that the file is the same without reading it
+        if (current_load.file_size, current_load.file_mtime) == (previous_load.file_size, previous_load.file_mtime):
+            current_load.content_hash = previous_load.content_hash
+            current_load.row_count = previous_load.row_count
+            return 'skip', current_load
+        # The rows appended to a compressed file can't be located without decompressing it, so it's always reloaded
+        can_append = self.target_table.load_mode == 'append' and not self.from_zip and current_load.file_size > previous_load.file_size
+        current_load.content_hash, prefix_hash = hash_file(self.file_path, previous_load.file_size if can_append else None)
+        if current_load.content_hash == previous_load.content_hash:
+            current_load.row_count = previous_load.row_count
+            return 'skip', current_load
+        if prefix_hash == previous_load.content_hash and self._is_record_boundary(previous_load.file_size):
+            current_load.row_count = previous_load.row_count
+            return 'append', current_load
+        return 'full', current_load
+
+    def _is_truncated_by_crash(self, cursor, previous_load: LoadManifestEntry) -> bool:
+        """
+        Checks if the target table is unlogged and empty although rows were loaded into it. Postgres truncates the unlogged tables
+        when it recovers from a crash, while the manifest entry of their last load is kept
+        """
+        cursor.execute('SELECT relpersistence FROM pg_class WHERE oid = to_regclass(%s)', (self.target_table.qualified_name,))
+        if cursor.fetchone()[0] != 'u' or previous_load.row_count == 0:
+            return False
+        cursor.execute(f'SELECT NOT EXISTS (SELECT 1 FROM {self.target_table.qualified_name})')
+        return cursor.fetchone()[0]
+
+    def _is_record_boundary(self, offset: int) -> bool:
+        """Checks if a given byte offset of the CSV file is the start of a record"""
+        with open(self.file_path, 'rb') as ifile:
+            ifile.seek(offset - 1)
+            return ifile.read(1) == b'\n'
+
+def _load_csv_partition(
+        pg_conn_kwargs: Dict[str, Any],
+        copy_stmt: str,
+        file_path: str,
+        start: int,
+        end: int,
+        header: bytes,
+        encoding: str,
+        sanitizer_factory: Callable[[io.TextIOBase], io.IOBase]
+    ) -> Tuple[int, float, Optional[StreamingQualityChecker], int]:
+    """
+    Loads a byte range of a csv file using its own connection. Runs in a worker process. Returns the number of loaded rows,
+    the time spent sanitizing them, the quality checks computed over them and the peak RSS of the worker
+    """
+    pg_conn = psycopg2.connect(**pg_conn_kwargs)
+    try:
+        with pg_conn, pg_conn.cursor() as cursor, open_csv_partition(file_path, start, end, header, encoding) as ifile:
+            sanitizer = sanitizer_factory(ifile)
+            num_rows, sanitize_time = copy_from_sanitizer(cursor, copy_stmt, sanitizer)
+            return num_rows, sanitize_time, sanitizer.quality_checker, get_peak_rss()
+    finally:
+        pg_conn.close()
+
+def _execute_maintenance_stmt(pg_conn_kwargs: Dict[str, Any], stmt: str) -> None:
+    """Runs a maintenance statement (e.g. CREATE INDEX) in its own connection, so several of them can run in parallel"""
+    pg_conn = psycopg2.connect(**pg_conn_kwargs)
+    pg_conn.autocommit = True
+    try:
+        with pg_conn.cursor() as cursor:
+            cursor.execute('SET maintenance_work_mem = %s', (INDEX_MAINTENANCE_WORK_MEM,))
+            cursor.execute(stmt)
+    finally:
+        pg_conn.close()
+
+def copy_from_sanitizer(cursor, copy_stmt: str, sanitizer: io.IOBase) -> Tuple[int, float]:
+    """Streams the output of a sanitizer into the db through a COPY statement. Returns the number of loaded rows and the time spent sanitizing them"""
+    if isinstance(sanitizer, BinaryCopyCSVSanitizer):
+        # The binary format sends the text fields as-is, encoded as utf-8 by the sanitizer
+        cursor.execute("SET client_encoding TO 'UTF8'")
+    timed_sanitizer = TimedReader(sanitizer)
+    cursor.copy_expert(copy_stmt, timed_sanitizer, size=COPY_BUFFER_SIZE)
+    return cursor.rowcount, timed_sanitizer.read_time
+
+def get_pg_conn_kwargs(pg_creds) -> Dict[str, Any]:
+    """Translates the connection credentials into psycopg2's connection arguments"""
+    return {
+        'host': pg_creds.host,
+        'dbname': pg_creds.schema,
+        'user': pg_creds.login,
+        'password': pg_creds.password,
+        'port': pg_creds.port
+    }
+
+def load_csv_to_postgres(
+        pg_creds,
+        kaggle_dbt_source_cfg: KaggleDbtSource,
+        target_table: str,
+        download_dir: str = '/tmp',
+        force: bool=False,
+        from_zip: bool=False,
+        ti=None,
+        run_id: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+    """
+    Creates the db connection and runs the DB management methods. Returns the metrics of the stages run by this task
+    and its upstream tasks, which are also stored in the db. Airflow passes ti & run_id and pushes the metrics to XCom.
+    """
     # Build the loader object
-    kaggle_table_loader = KaggleDbtTableLoader(kaggle_dbt_source_cfg, target_table, download_dir)
+    kaggle_table_loader = KaggleDbtTableLoader(kaggle_dbt_source_cfg, target_table, download_dir, from_zip)
+    pg_conn_kwargs = get_pg_conn_kwargs(pg_creds)
     try:
         # Ducktype the connection
         # Create the connection here to be able to leverage parallelism in airflow, cursors created from the same connection
         # will belong to the same session and will execute statements in series.
-        pg_conn = psycopg2.connect(
-            host=pg_creds.host,
-            dbname=pg_creds.schema,
-            user=pg_creds.login,
-            password=pg_creds.password,
-            port=pg_creds.port
-        )
+        pg_conn = psycopg2.connect(**pg_conn_kwargs)
         pg_conn.autocommit = True   # Autocommit to avoid spamming it later
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
 
-    # Run the DDL/DML in order. Re-create everything to guarantee correctness.
+    _run_load(pg_conn, pg_conn_kwargs, kaggle_table_loader, force)
+
+    # Gather the metrics pushed to XCom by the upstream tasks (e.g. the download) and store them together with ours
+    upstream_metrics = []
+    if ti is not None:
+        for task_metrics in ti.xcom_pull(task_ids=list(ti.task.upstream_task_ids)) or []:
+            upstream_metrics.extend(task_metrics if isinstance(task_metrics, list) else [])
+    # The upstream tasks only know about files, so attribute the metrics of this table's file to the table.
+    # A dataset download task reports the metrics of all the dataset's files
+    kaggle_file_name = kaggle_table_loader.target_table.kaggle_file_name
+    metrics = [
+        dict(m, table_name=kaggle_table_loader.target_table.qualified_name)
+        for m in upstream_metrics if m.get('table_name') in (None, kaggle_file_name)
+    ]
+    metrics.extend(kaggle_table_loader.metrics.to_dicts())
+    pg_conn.autocommit = True
+    with pg_conn.cursor() as cursor:
+        create_stage_metrics_table(cursor)
+        insert_stage_metrics(cursor, run_id, metrics)
+    pg_conn.close()
+    return metrics
+
+def _run_load(pg_conn, pg_conn_kwargs: Dict[str, Any], kaggle_table_loader: KaggleDbtTableLoader, force: bool) -> None:
+    """Loads the table, skipping it if the file hasn't changed and appending to it if the file only has new rows"""
+    start_time = time.time()
+    # Check the file against the previous load to avoid re-loading unchanged data
+    with pg_conn.cursor() as cursor:
+        create_load_manifest(cursor)
+        create_partition_tracking_tables(cursor)
+        create_quality_checks_table(cursor)
+        previous_load = None if force else get_load_manifest_entry(cursor, kaggle_table_loader.target_table.qualified_name)
+        with kaggle_table_loader.metrics.stage('plan'):
+            load_type, current_load = kaggle_table_loader.plan_load(cursor, previous_load)
+
+    if load_type == 'skip':
+        print(f'File {kaggle_table_loader.file_path} has not changed since the last load. Skipping load')
+        with pg_conn.cursor() as cursor:
+            current_load.load_duration = previous_load.load_duration
+            upsert_load_manifest_entry(cursor, current_load)
+        return
+
+    if load_type == 'append':
+        # Append in a single transaction so readers never see a partially appended table
+        pg_conn.autocommit = False
+        with pg_conn, pg_conn.cursor() as cursor:
+            current_load.row_count += kaggle_table_loader.append_data_from_csv(cursor, previous_load.file_size)
+            kaggle_table_loader.track_changed_partitions(cursor, kaggle_table_loader.target_table.qualified_name)
+            kaggle_table_loader.store_quality_checks(cursor, kaggle_table_loader.target_table.qualified_name, current_load.row_count, append=True)
+            current_load.load_duration = time.time() - start_time
+            upsert_load_manifest_entry(cursor, current_load)
+        return
+
+    # Load the data into a shadow table and swap it with the target table, so the latter is never missing or half-loaded
     with pg_conn.cursor() as cursor:
-        kaggle_table_loader.drop_table(cursor)
         kaggle_table_loader.create_schema(cursor)
-        kaggle_table_loader.create_table(cursor)
-        kaggle_table_loader.load_data_from_csv(cursor)
\ No newline at end of file
+        kaggle_table_loader.create_shadow_table(cursor)
+        try:
+            # A compressed file can't be split in byte ranges, so it's always loaded by a single worker
+            if kaggle_table_loader.target_table.load_workers > 1 and not kaggle_table_loader.from_zip:
+                current_load.row_count = kaggle_table_loader.load_data_from_csv_partitioned(pg_conn_kwargs)
+            else:
+                current_load.row_count = kaggle_table_loader.load_data_from_csv(cursor)
+            # SET LOGGED rewrites the table and rebuilds its indexes serially, so it's done before building them
+            if kaggle_table_loader.target_table.logged:
+                kaggle_table_loader.set_shadow_table_logged(cursor)
+            kaggle_table_loader.build_shadow_table_indexes(cursor, pg_conn_kwargs)
+            kaggle_table_loader.analyze_shadow_table(cursor)
+        except Exception:
+            kaggle_table_loader.drop_shadow_table(cursor)
+            raise
+    # Leave autocommit so the swap & the manifest update happen in a single transaction
+    pg_conn.autocommit = False
+    with pg_conn, pg_conn.cursor() as cursor:
+        # Fingerprint the shadow table before the swap, so the target table isn't locked meanwhile
+        kaggle_table_loader.track_changed_partitions(cursor, kaggle_table_loader.qualified_shadow_table_name)
+        kaggle_table_loader.store_quality_checks(cursor, kaggle_table_loader.qualified_shadow_table_name, current_load.row_count)
+        kaggle_table_loader.swap_shadow_table(cursor)
+        current_load.load_duration = time.time() - start_time
+        upsert_load_manifest_entry(cursor, current_load)
@@ -1,6 +1,13 @@
 import os
+import json
 import yaml
-from typing import Dict, Any
+import pickle
+import hashlib
+import tempfile
+from typing import Dict, Any, List, Optional, Tuple
+
+# Index of the parsed source configs, stored in the dbt project's target dir (ignored by git & wiped by dbt clean)
+SOURCE_CONFIGS_INDEX_PATH = 'target/kaggle_source_configs.pickle'
 
 class KaggleDbtSourceTableColumn:
     """A class representig a dbt source column, enriched with the kaggle metadata"""
@@ -9,6 +16,49 @@ class KaggleDbtSourceTableColumn:
         self.name = dbt_yaml['name']
         self.data_type = dbt_yaml['data_type']
         self.kaggle_column_name = dbt_yaml['meta']['kaggle_column_name']
+        self.tests = dbt_yaml.get('tests', [])
+        # Index hints: index can be true (btree) or the name of an index method (hash, brin...)
+        self.index = dbt_yaml['meta'].get('index', False)
+        self.primary_key = bool(dbt_yaml['meta'].get('primary_key', False))
+
+    @property
+    def accepted_values(self) -> Optional[List[str]]:
+        """Returns the values accepted by the column's accepted_values test, if it has one"""
+        for test in self.tests:
+            if isinstance(test, dict) and 'accepted_values' in test:
+                return test['accepted_values']['values']
+        return None
+
+    @property
+    def not_null(self) -> bool:
+        """Returns whether the column is tested to have no nulls"""
+        return 'not_null' in self.tests
+
+    @property
+    def unique(self) -> bool:
+        """Returns whether the column is tested to have unique values"""
+        return 'unique' in self.tests
+
+class KaggleDbtSourceTableIndex:
+    """A class representing an index built on a source table after loading it"""
+    def __init__(self, columns: List[str], method: str='btree', unique: bool=False, primary_key: bool=False):
+        """Constructs all necessary attributes for the object"""
+        self.columns = list(columns)
+        self.method = method
+        self.unique = unique or primary_key
+        self.primary_key = primary_key
+
+    @classmethod
+    def from_yaml(cls, dbt_yaml: Dict[str, Any]) -> 'KaggleDbtSourceTableIndex':
+        """Builds an index from its definition in the table's meta"""
+        return cls(dbt_yaml['columns'], dbt_yaml.get('method', 'btree'), bool(dbt_yaml.get('unique', False)))
+
+    @property
+    def name_suffix(self) -> str:
+        """Returns the suffix used to name the index after its table"""
+        if self.primary_key:
+            return 'pkey'
+        return f"{'_'.join(self.columns)}_{'key' if self.unique else 'idx'}"
 
 class KaggleDbtSourceTable:
     """A class representig a dbt source table, enriched with the kaggle metadata"""
@@ -17,22 +67,59 @@ class KaggleDbtSourceTable:
         self.name = dbt_yaml['name']
         self.schema = schema
         self.kaggle_file_name = dbt_yaml['meta']['kaggle_file_name']
+        # Number of parallel workers used to load the table. More than one enables the partitioned load
+        self.load_workers = int(dbt_yaml['meta'].get('load_workers', 1))
+        # Tables are loaded into an UNLOGGED shadow table for speed, and made logged before they are swapped in so they are crash-safe
+        # & replicated. Set logged to false to keep them unlogged, as they can be rebuilt from the csv
+        self.logged = bool(dbt_yaml['meta'].get('logged', True))
+        # How to load the table when its file changes: 'full' reloads it, 'append' only loads the new rows at the end of the file
+        self.load_mode = dbt_yaml['meta'].get('load_mode', 'full')
+        # Format used to COPY the data into the db: 'csv' or 'binary', which encodes the rows client-side using the column data types
+        self.copy_format = dbt_yaml['meta'].get('copy_format', 'csv')
         self.columns = {c['name']: KaggleDbtSourceTableColumn(c) for c in dbt_yaml.get('columns', [])}
+        # Indexes & constraints, built after the data is loaded. They can be declared on the columns or on the table
+        self.primary_key = dbt_yaml['meta'].get('primary_key', [c.name for c in self.columns.values() if c.primary_key])
+        self.indexes = [
+            KaggleDbtSourceTableIndex([c.name], 'btree' if c.index is True else c.index)
+            for c in self.columns.values() if c.index
+        ] + [KaggleDbtSourceTableIndex.from_yaml(i) for i in dbt_yaml['meta'].get('indexes', [])]
+        # Columns the table is physically sorted by, with CLUSTER, so range scans & joins on them read less pages
+        self.cluster_by = dbt_yaml['meta'].get('cluster_by', [])
+        # Number of indexes built at the same time, each one by its own connection
+        self.index_workers = int(dbt_yaml['meta'].get('index_workers', 4))
+        # SQL expression grouping the rows into partitions (e.g. the year of a date). The loader records which partitions changed
+        # on each load, so the incremental dbt models built on top of the table only rebuild those
+        self.partition_key = dbt_yaml['meta'].get('partition_key')
+        # Date column whose year the parquet snapshot is partitioned by, if any
+        self.parquet_partition_by = dbt_yaml['meta'].get('parquet_partition_by')
+        # Number of rows the table is expected to have, checked by the assert_num_loaded_rows test
+        self.expected_rows = dbt_yaml['meta'].get('expected_rows')
+        self.tests = dbt_yaml.get('tests', [])
     
     @property
     def qualified_name(self) -> str:
         """Returns the qualified name for the source table"""
         return f'{self.schema}.{self.name}'
     
+    @property
+    def primary_key_index(self) -> Optional[KaggleDbtSourceTableIndex]:
+        """Returns the unique index backing the primary key, if the table has one"""
+        return KaggleDbtSourceTableIndex(self.primary_key, primary_key=True) if self.primary_key else None
+
+    @property
+    def unique_indexed_columns(self) -> List[str]:
+        """Returns the columns whose uniqueness is enforced by a single column unique index (or primary key) built on the table"""
+        indexes = self.indexes + ([self.primary_key_index] if self.primary_key_index else [])
+        return [i.columns[0] for i in indexes if i.unique and len(i.columns) == 1]
+
     def get_kaggle_to_dbt_mapping(self) -> Dict[str, str]:
         """Gets the mapping from the original names in the kaggle dataset to the sanitized names"""
         return {c.kaggle_column_name: c.name for c in self.columns.values()}
 
 class KaggleDbtSource:
     """A class representig a dbt source, enriched with the kaggle metadata. Can contain one or more tables"""
-    def __init__(self, dbt_yaml: Dict[str, Any]):
-        """Constructs all necessary attributes for the object from a parsed dby .yml file"""
-        yaml_dbt_source = dbt_yaml['sources'][0]
+    def __init__(self, yaml_dbt_source: Dict[str, Any]):
+        """Constructs all necessary attributes for the object from one of the sources of a parsed dbt .yml file"""
         self.name = yaml_dbt_source['name']
         self.schema = yaml_dbt_source['schema']
         # Pull the kaggle dataset name & parse it
@@ -43,6 +130,21 @@ class KaggleDbtSource:
         self.delimiter = yaml_dbt_source['meta'].get('delimiter', '|')
         self.null_value = yaml_dbt_source['meta'].get('null_value', 'NA')
         self.encoding = yaml_dbt_source['meta'].get('encoding', 'utf-8')
+        # Whether to load the files streaming them out of the downloaded zip files instead of extracting them first
+        self.streaming_load = bool(yaml_dbt_source['meta'].get('streaming_load', False))
+        # Number of files of the dataset downloaded at the same time
+        self.download_workers = int(yaml_dbt_source['meta'].get('download_workers', 4))
+        # Whether to write parquet snapshots of the tables & presentation models alongside the db load
+        self.parquet_export = bool(yaml_dbt_source['meta'].get('parquet_export', False))
+        # Number of threads of the single dbt invocation that runs all the tests of the source
+        self.dbt_threads = int(yaml_dbt_source['meta'].get('dbt_threads', 4))
+        # Directory the files are downloaded to. Each dataset gets its own subdirectory of the global download dir by default
+        self.download_dir = yaml_dbt_source['meta'].get('download_dir')
+        # Schedule of the dataset's DAG (a cron expression or preset like '@daily'). Unscheduled by default
+        self.schedule = yaml_dbt_source['meta'].get('schedule')
+        # Airflow pools limiting the concurrent downloads & loads. The global ones are used by default, so a dataset can be isolated in its own
+        self.download_pool = yaml_dbt_source['meta'].get('download_pool')
+        self.load_pool = yaml_dbt_source['meta'].get('load_pool')
         # Build the tables. Pass the schema for convenience
         self.tables = {t['name']: KaggleDbtSourceTable(t, self.schema) for t in yaml_dbt_source['tables']}
 
@@ -55,15 +157,96 @@ class KaggleDbtSource:
         """Returns a given table"""
         return self.tables[table_name]
 
-def read_kaggle_dbt_source_configs(dbt_project_path: str, dbt_project_name: str) -> KaggleDbtSource:
-    """Reads and parses all dbt source configuration files (with the right naming) in a dbt project"""
+    def get_table_load_fingerprint(self, table_name: str) -> str:
+        """
+        Returns a fingerprint of everything that determines how a table is loaded: the csv configs, its columns & types, the copy
+        format, its persistence and its indexes. A table whose fingerprint changed is reloaded even if its file hasn't
+        """
+        table = self.get_table(table_name)
+        load_config = {
+            'csv': [self.delimiter, self.null_value, self.encoding],
+            'columns': [[c.name, c.data_type, c.kaggle_column_name] for c in table.columns.values()],
+            'copy_format': table.copy_format,
+            'logged': table.logged,
+            'primary_key': table.primary_key,
+            'indexes': [[i.columns, i.method, i.unique] for i in table.indexes],
+            'cluster_by': table.cluster_by,
+        }
+        return hashlib.sha256(json.dumps(load_config, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_download_path(self, download_dir: str) -> str:
+        """Returns the directory the files of the dataset are downloaded to, given the global download dir"""
+        return self.download_dir or f'{download_dir}/{self.name}'
+
+def find_kaggle_dbt_source_files(dbt_models_path: str) -> List[str]:
+    """Finds all dbt source configuration files (named src_*.yml) in the models directory of a dbt project, at any depth"""
+    file_paths = []
+    for dir_path, dir_names, file_names in os.walk(dbt_models_path):
+        # Walk the directories in a stable order, so the configs are always read in the same order
+        dir_names.sort()
+        file_paths.extend(f'{dir_path}/{f}' for f in sorted(file_names) if f.startswith('src_') and f.endswith('.yml'))
+    return file_paths
+
+def read_kaggle_dbt_source_configs(dbt_project_path: str, dbt_project_name: str) -> Dict[str, KaggleDbtSource]:
+    """
+    Reads and parses all dbt source configuration files (with the right naming) in a dbt project. A file can define several sources,
+    and only the ones with a kaggle_dataset in their meta are read
+    """
     dbt_source_cfgs = {}
     dbt_models_path = f'{dbt_project_path}/{dbt_project_name}/models'
-    for ds in os.listdir(dbt_models_path):
-        with open(f'{dbt_models_path}/{ds}/sources/src_{ds}.yml', 'r') as ifile:
+    for file_path in find_kaggle_dbt_source_files(dbt_models_path):
+        with open(file_path, 'r') as ifile:
             try:
-                dataset_cfg = KaggleDbtSource(yaml.safe_load(ifile))
+                dbt_yaml = yaml.safe_load(ifile) or {}
             except yaml.YAMLError as e:
                 print(e)
-        dbt_source_cfgs[dataset_cfg.name] = dataset_cfg
-    return dbt_source_cfgs
\ No newline at end of file
+                continue
+        for yaml_dbt_source in dbt_yaml.get('sources', []):
+            if 'kaggle_dataset' not in (yaml_dbt_source.get('meta') or {}):
+                continue
+            dataset_cfg = KaggleDbtSource(yaml_dbt_source)
+            # The source name identifies the dataset's DAG, tasks & download dir
+            if dataset_cfg.name in dbt_source_cfgs:
+                raise ValueError(f'Source {dataset_cfg.name} is defined more than once ({file_path})')
+            dbt_source_cfgs[dataset_cfg.name] = dataset_cfg
+    return dbt_source_cfgs
+
+def _get_source_configs_fingerprint(dbt_models_path: str) -> Tuple:
+    """
+    Builds a fingerprint of the dbt source configuration files from their paths, sizes & modification times.
+    The parsing code is included too, so the index is rebuilt when the classes change
+    """
+    file_paths = [__file__] + find_kaggle_dbt_source_files(dbt_models_path)
+    fingerprint = []
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        fingerprint.append((file_path, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+def read_kaggle_dbt_source_configs_cached(dbt_project_path: str, dbt_project_name: str, index_path: Optional[str] = None) -> Dict[str, KaggleDbtSource]:
+    """
+    Reads the dbt source configs like read_kaggle_dbt_source_configs, but keeps the parsed configs in an index file next to
+    the dbt project. The index is only rebuilt when any of the source files changes, so re-parsing the DAG only costs a stat per file
+    """
+    dbt_models_path = f'{dbt_project_path}/{dbt_project_name}/models'
+    index_path = index_path or f'{dbt_project_path}/{dbt_project_name}/{SOURCE_CONFIGS_INDEX_PATH}'
+    fingerprint = _get_source_configs_fingerprint(dbt_models_path)
+    try:
+        with open(index_path, 'rb') as ifile:
+            index = pickle.load(ifile)
+        if index['fingerprint'] == fingerprint:
+            return index['configs']
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError, AttributeError, ImportError):
+        # Missing, corrupted or outdated index. Just rebuild it
+        pass
+    dbt_source_cfgs = read_kaggle_dbt_source_configs(dbt_project_path, dbt_project_name)
+    # Write to a temp file & rename it, so concurrent DAG parses never read a half-written index
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(index_path), delete=False) as ofile:
+            pickle.dump({'fingerprint': fingerprint, 'configs': dbt_source_cfgs}, ofile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(ofile.name, index_path)
+    except OSError as e:
+        # The configs are still valid, they just won't be cached (e.g. the dbt project is read-only)
+        print(f'Could not write the source configs index to {index_path}: {e}')
+    return dbt_source_cfgs
@@ -0,0 +1,132 @@
+import hashlib
+
+from typing import List, Optional, Tuple
+
+# Schema holding the bookkeeping tables of the ELT pipelines
+ELT_SCHEMA = 'kaggle_elt'
+LOAD_MANIFEST_TABLE = f'{ELT_SCHEMA}.load_manifest'
+# Migrations already applied to the bookkeeping tables
+SCHEMA_MIGRATIONS_TABLE = f'{ELT_SCHEMA}.schema_migrations'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class LoadManifestEntry:
+    """A class representing the state of the file a source table was last loaded from"""
+    def __init__(
+            self,
+            table_name: str,
+            file_size: int,
+            file_mtime: float,
+            content_hash: str,
+            row_count: int,
+            load_duration: float,
+            config_fingerprint: Optional[str] = None
+        ):
+        """Constructs all necessary attributes for the object"""
+        self.table_name = table_name
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self.content_hash = content_hash
+        self.row_count = row_count
+        self.load_duration = load_duration
+        # Fingerprint of the table's definition (columns, types, indexes...) the file was loaded with
+        self.config_fingerprint = config_fingerprint
+
+def apply_migration(cursor, migration_id: str, stmts: List[str]) -> None:
+    """
+    Runs the statements upgrading the bookkeeping tables created by older versions of the pipeline, only the first time.
+    Concurrent tasks are serialized with an advisory lock. The statements must be idempotent, in case a task dies halfway
+    """
+    cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {ELT_SCHEMA};')
+    cursor.execute(
+        f"""CREATE TABLE IF NOT EXISTS {SCHEMA_MIGRATIONS_TABLE} (
+            migration_id VARCHAR(255) PRIMARY KEY,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );"""
+    )
+    cursor.execute(f'SELECT 1 FROM {SCHEMA_MIGRATIONS_TABLE} WHERE migration_id = %s', (migration_id,))
+    if cursor.fetchone():
+        return
+    cursor.execute('SELECT pg_advisory_lock(hashtext(%s))', (SCHEMA_MIGRATIONS_TABLE,))
+    try:
+        cursor.execute(f'SELECT 1 FROM {SCHEMA_MIGRATIONS_TABLE} WHERE migration_id = %s', (migration_id,))
+        if cursor.fetchone():
+            return
+        print(f'Attempting to apply migration {migration_id}...')
+        for stmt in stmts:
+            cursor.execute(stmt)
+        cursor.execute(f'INSERT INTO {SCHEMA_MIGRATIONS_TABLE} (migration_id) VALUES (%s)', (migration_id,))
+        print(f'Done')
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(hashtext(%s))', (SCHEMA_MIGRATIONS_TABLE,))
+
+def create_load_manifest(cursor) -> None:
+    """Creates the load manifest table if it doesn't exist"""
+    cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {ELT_SCHEMA};')
+    cursor.execute(
+        f"""CREATE TABLE IF NOT EXISTS {LOAD_MANIFEST_TABLE} (
+            table_name VARCHAR(255) PRIMARY KEY,
+            file_size BIGINT NOT NULL,
+            file_mtime DOUBLE PRECISION NOT NULL,
+            content_hash VARCHAR(64) NOT NULL,
+            row_count BIGINT NOT NULL,
+            load_duration DOUBLE PRECISION NOT NULL,
+            config_fingerprint VARCHAR(64),
+            loaded_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );"""
+    )
+    apply_migration(
+        cursor,
+        'load_manifest_config_fingerprint',
+        [f'ALTER TABLE {LOAD_MANIFEST_TABLE} ADD COLUMN IF NOT EXISTS config_fingerprint VARCHAR(64);']
+    )
+
+def get_load_manifest_entry(cursor, table_name: str) -> Optional[LoadManifestEntry]:
+    """Gets the manifest entry of a table, if it has been loaded before"""
+    cursor.execute(
+        f"""SELECT table_name, file_size, file_mtime, content_hash, row_count, load_duration, config_fingerprint
+              FROM {LOAD_MANIFEST_TABLE}
+             WHERE table_name = %s""",
+        (table_name,)
+    )
+    row = cursor.fetchone()
+    return LoadManifestEntry(*row) if row else None
+
+def upsert_load_manifest_entry(cursor, entry: LoadManifestEntry) -> None:
+    """Inserts or replaces the manifest entry of a table"""
+    cursor.execute(
+        f"""INSERT INTO {LOAD_MANIFEST_TABLE} (table_name, file_size, file_mtime, content_hash, row_count, load_duration, config_fingerprint)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (table_name) DO UPDATE
+               SET file_size = EXCLUDED.file_size,
+                   file_mtime = EXCLUDED.file_mtime,
+                   content_hash = EXCLUDED.content_hash,
+                   row_count = EXCLUDED.row_count,
+                   load_duration = EXCLUDED.load_duration,
+                   config_fingerprint = EXCLUDED.config_fingerprint,
+                   loaded_at = NOW()""",
+        (entry.table_name, entry.file_size, entry.file_mtime, entry.content_hash, entry.row_count, entry.load_duration, entry.config_fingerprint)
+    )
+
+def hash_file(file_path: str, prefix_size: Optional[int] = None) -> Tuple[str, Optional[str]]:
+    """
+    Computes the sha256 of a file in a single pass. If prefix_size is provided it also returns the hash of
+    the first prefix_size bytes, which allows to check if the file has only been appended to.
+    """
+    file_hash = hashlib.sha256()
+    prefix_hash = None
+    read_bytes = 0
+    with open(file_path, 'rb') as ifile:
+        while True:
+            chunk = ifile.read(HASH_CHUNK_SIZE)
+            if not chunk: break
+            if prefix_size is not None and read_bytes <= prefix_size < read_bytes + len(chunk):
+                file_hash.update(chunk[:prefix_size - read_bytes])
+                prefix_hash = file_hash.hexdigest()
+                file_hash.update(chunk[prefix_size - read_bytes:])
+            else:
+                file_hash.update(chunk)
+            read_bytes += len(chunk)
+    if prefix_size is not None and prefix_size == read_bytes:
+        prefix_hash = file_hash.hexdigest()
+    return file_hash.hexdigest(), prefix_hash
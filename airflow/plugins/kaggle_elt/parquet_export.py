@@ -0,0 +1,202 @@
+import io
+import os
+import shutil
+import psycopg2
+
+from kaggle_elt.kaggle_dbt_source import KaggleDbtSource, KaggleDbtSourceTable
+from kaggle_elt.csv_sanitizer import BatchedCSVSanitizer
+from kaggle_elt.kaggle_dbt_loader import KaggleDbtTableLoader, get_pg_conn_kwargs
+from kaggle_elt.stage_metrics import StageMetricsRecorder
+from typing import Any, Dict, Iterator, List, Optional
+
+# Bytes of csv parsed into each record batch written to the parquet files
+PARQUET_BLOCK_SIZE = 16 * 1024 * 1024
+PARQUET_COMPRESSION = 'zstd'
+
+class EncodedTextReader(io.RawIOBase):
+    """A class that wraps a text file-like object (e.g. a sanitizer) into a binary one, as expected by pyarrow's csv reader"""
+    def __init__(self, file, encoding: str='utf-8'):
+        """Constructs all necessary attributes for the object"""
+        self._file = file
+        self._encoding = encoding
+        self._buffer = b''
+
+    def read(self, n: Optional[int] = None) -> bytes:
+        """Reads up to n bytes from the input"""
+        if n is None or n < 0:
+            data, self._buffer = self._buffer + self._file.read().encode(self._encoding), b''
+            return data
+        # Non-ascii characters take more than one byte, so the text is read until there are enough bytes
+        while len(self._buffer) < n:
+            chunk = self._file.read(n)
+            if not chunk: break
+            self._buffer += chunk.encode(self._encoding)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def readable(self) -> bool:
+        """Return true to indicate that the object is readable"""
+        return True
+
+def get_arrow_type(data_type: str):
+    """Returns the arrow type matching a given postgres data type, ignoring its modifiers except for the numeric precision & scale"""
+    # pyarrow is an optional dependency, only needed to export parquet files
+    import pyarrow as pa
+    type_name = ' '.join(data_type.split('(')[0].upper().split())
+    if type_name in ('NUMERIC', 'DECIMAL') and '(' in data_type:
+        precision, _, scale = data_type.split('(')[1].rstrip(') ').partition(',')
+        return pa.decimal128(int(precision), int(scale or 0))
+    arrow_types = {
+        'VARCHAR': pa.string(),
+        'CHARACTER VARYING': pa.string(),
+        'CHAR': pa.string(),
+        'CHARACTER': pa.string(),
+        'TEXT': pa.string(),
+        'SMALLINT': pa.int16(),
+        'INT2': pa.int16(),
+        'INTEGER': pa.int32(),
+        'INT': pa.int32(),
+        'INT4': pa.int32(),
+        'BIGINT': pa.int64(),
+        'INT8': pa.int64(),
+        'REAL': pa.float32(),
+        'FLOAT4': pa.float32(),
+        'DOUBLE PRECISION': pa.float64(),
+        'FLOAT8': pa.float64(),
+        'FLOAT': pa.float64(),
+        'NUMERIC': pa.float64(),
+        'DECIMAL': pa.float64(),
+        'DATE': pa.date32(),
+        'BOOLEAN': pa.bool_(),
+        'BOOL': pa.bool_(),
+    }
+    if type_name not in arrow_types:
+        raise ValueError(f'Data type {data_type} is not supported by the parquet export')
+    return arrow_types[type_name]
+
+def get_partition_column_name(partition_by: str) -> str:
+    """Returns the name of the column the files are partitioned by, which holds the year of the partitioning date"""
+    return f'{partition_by}_year'
+
+def get_parquet_snapshot_path(parquet_dir: str, schema: str, table_name: str) -> str:
+    """Returns the directory the parquet snapshot of a table is written to"""
+    return f'{parquet_dir}/{schema}/{table_name}'
+
+def _replace_directory(tmp_path: str, target_path: str) -> None:
+    """Replaces a directory with a freshly written one, so readers only ever see complete snapshots"""
+    old_path = f'{target_path}.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.isdir(target_path):
+        os.rename(target_path, old_path)
+    os.rename(tmp_path, target_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+def _write_parquet_snapshot(batches: Iterator, schema, target_path: str, partition_by: Optional[str] = None) -> int:
+    """
+    Writes a stream of record batches as a compressed parquet dataset, hive-partitioned by the year of a date column if given.
+    Returns the number of written rows
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    num_rows = 0
+    partitioning = None
+    if partition_by:
+        partition_column = get_partition_column_name(partition_by)
+        schema = schema.append(pa.field(partition_column, pa.int32()))
+        partitioning = ds.partitioning(pa.schema([schema.field(partition_column)]), flavor='hive')
+
+    def _prepare_batches():
+        """Adds the partition column to each batch & counts the rows"""
+        nonlocal num_rows
+        for batch in batches:
+            num_rows += batch.num_rows
+            if partition_by:
+                year = pc.cast(pc.year(batch.column(partition_by)), pa.int32())
+                batch = pa.RecordBatch.from_arrays(batch.columns + [year], schema=schema)
+            yield batch
+
+    tmp_path = f'{target_path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    ds.write_dataset(
+        _prepare_batches(),
+        tmp_path,
+        schema=schema,
+        format='parquet',
+        partitioning=partitioning,
+        file_options=ds.ParquetFileFormat().make_write_options(compression=PARQUET_COMPRESSION)
+    )
+    _replace_directory(tmp_path, target_path)
+    return num_rows
+
+def export_table_to_parquet(
+        kaggle_dbt_source_cfg: KaggleDbtSource,
+        target_table: str,
+        parquet_dir: str,
+        download_dir: str = '/tmp'
+    ) -> List[Dict[str, Any]]:
+    """
+    Writes a parquet snapshot of a source table straight from its downloaded csv file (or zip file), using the same sanitizer,
+    column names & data types as the db load. Returns the metrics of the export stage, which Airflow pushes to XCom
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    # Read the file the same way it's loaded into the db
+    loader = KaggleDbtTableLoader(kaggle_dbt_source_cfg, target_table, download_dir, from_zip=kaggle_dbt_source_cfg.streaming_load)
+    table_cfg: KaggleDbtSourceTable = loader.target_table
+    column_types = {c.name: get_arrow_type(c.data_type) for c in table_cfg.columns.values()}
+    target_path = get_parquet_snapshot_path(parquet_dir, table_cfg.schema, table_cfg.name)
+    metrics = StageMetricsRecorder(table_cfg.qualified_name)
+    print(f'Attempting to export table {table_cfg.qualified_name} to {target_path}...')
+    with metrics.stage('parquet_export') as export_metrics, loader.open_csv() as ifile:
+        sanitizer = BatchedCSVSanitizer(ifile, table_cfg.get_kaggle_to_dbt_mapping())
+        reader = pa_csv.open_csv(
+            EncodedTextReader(sanitizer),
+            read_options=pa_csv.ReadOptions(block_size=PARQUET_BLOCK_SIZE),
+            parse_options=pa_csv.ParseOptions(delimiter='|', quote_char=False),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=column_types,
+                null_values=[kaggle_dbt_source_cfg.null_value],
+                strings_can_be_null=True
+            )
+        )
+        # The columns are written in the order of the dbt source, regardless of their order in the csv
+        schema = pa.schema([(name, column_types[name]) for name in column_types])
+        column_idx = [reader.schema.get_field_index(name) for name in schema.names]
+        batches = (pa.RecordBatch.from_arrays([b.column(i) for i in column_idx], schema=schema) for b in reader)
+        export_metrics.rows_emitted = _write_parquet_snapshot(batches, schema, target_path, table_cfg.parquet_partition_by)
+        export_metrics.bytes_read = os.path.getsize(loader.file_path)
+    print(f'Done')
+    return metrics.to_dicts()
+
+def export_models_to_parquet(pg_creds, schema: str, model_prefix: str, parquet_dir: str) -> List[Dict[str, Any]]:
+    """
+    Writes a parquet snapshot of each one of the dbt models in a schema whose name starts with a given prefix (e.g. the presentation
+    models of a source). Returns the metrics of the export stages
+    """
+    import pyarrow.csv as pa_csv
+    pg_conn = psycopg2.connect(**get_pg_conn_kwargs(pg_creds))
+    pg_conn.autocommit = True
+    metrics = StageMetricsRecorder(f'{schema}.{model_prefix}*')
+    try:
+        with pg_conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT table_name FROM information_schema.tables WHERE table_schema = %s AND table_name LIKE %s",
+                (schema, model_prefix.replace('_', '\\_') + '%')
+            )
+            model_names = [row[0] for row in cursor.fetchall()]
+            for model_name in model_names:
+                target_path = get_parquet_snapshot_path(parquet_dir, schema, model_name)
+                print(f'Attempting to export model {schema}.{model_name} to {target_path}...')
+                with metrics.stage('parquet_export') as export_metrics:
+                    # The models are small aggregates, so they are exported in one go. The types are inferred from the csv
+                    buffer = io.BytesIO()
+                    cursor.copy_expert(f'COPY (SELECT * FROM {schema}.{model_name}) TO STDOUT WITH CSV HEADER', buffer)
+                    export_metrics.bytes_read = buffer.tell()
+                    buffer.seek(0)
+                    table = pa_csv.read_csv(buffer)
+                    export_metrics.rows_emitted = _write_parquet_snapshot(iter(table.to_batches()), table.schema, target_path)
+                print(f'Done')
+    finally:
+        pg_conn.close()
+    return metrics.to_dicts()
@@ -0,0 +1,94 @@
+from kaggle_elt.load_manifest import ELT_SCHEMA, apply_migration
+from typing import List
+
+# Per partition row count & content fingerprint of each source table, as of its last load
+PARTITION_FINGERPRINTS_TABLE = f'{ELT_SCHEMA}.partition_fingerprints'
+# Partitions whose content changed on each load. Read by the incremental dbt models to only rebuild what changed
+CHANGED_PARTITIONS_TABLE = f'{ELT_SCHEMA}.changed_partitions'
+# Latest build of each dbt model, with the txid snapshot it ran on. Written by the record_model_build dbt post-hook
+MODEL_BUILDS_TABLE = f'{ELT_SCHEMA}.model_builds'
+
+def create_partition_tracking_tables(cursor) -> None:
+    """Creates the partition tracking tables if they don't exist"""
+    cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {ELT_SCHEMA};')
+    cursor.execute(
+        f"""CREATE TABLE IF NOT EXISTS {PARTITION_FINGERPRINTS_TABLE} (
+            table_name VARCHAR(255) NOT NULL,
+            partition_key VARCHAR(255) NOT NULL,
+            row_count BIGINT NOT NULL,
+            fingerprint BIGINT NOT NULL,
+            PRIMARY KEY (table_name, partition_key)
+        );"""
+    )
+    cursor.execute(
+        f"""CREATE TABLE IF NOT EXISTS {CHANGED_PARTITIONS_TABLE} (
+            table_name VARCHAR(255) NOT NULL,
+            partition_key VARCHAR(255) NOT NULL,
+            detected_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            load_txid BIGINT NOT NULL DEFAULT txid_current()
+        );"""
+    )
+    # The id of the transaction that recorded the change tells the dbt models whether they have seen it, regardless of commit order
+    apply_migration(
+        cursor,
+        'changed_partitions_load_txid',
+        [f'ALTER TABLE {CHANGED_PARTITIONS_TABLE} ADD COLUMN IF NOT EXISTS load_txid BIGINT NOT NULL DEFAULT txid_current();']
+    )
+
+def record_changed_partitions(cursor, table_name: str, loaded_table_name: str, partition_key: str) -> List[str]:
+    """
+    Fingerprints each partition of a freshly loaded table (the sum of the hashes of its rows, so the row order doesn't matter)
+    and records the partitions that are new, gone or different since the previous load. Must be run in the same transaction
+    that makes the load visible. Returns the changed partitions
+    """
+    cursor.execute(
+        f"""CREATE TEMPORARY TABLE current_partition_fingerprints AS
+            SELECT COALESCE(({partition_key})::VARCHAR, '') AS partition_key,
+                   COUNT(*) AS row_count,
+                   SUM(hashtext(t::TEXT)::BIGINT) AS fingerprint
+              FROM {loaded_table_name} AS t
+             GROUP BY 1"""
+    )
+    cursor.execute(
+        f"""INSERT INTO {CHANGED_PARTITIONS_TABLE} (table_name, partition_key)
+            SELECT %s, partition_key
+              FROM current_partition_fingerprints AS c
+                FULL OUTER JOIN (SELECT * FROM {PARTITION_FINGERPRINTS_TABLE} WHERE table_name = %s) AS p
+                    USING (partition_key)
+             WHERE c.row_count IS DISTINCT FROM p.row_count
+                OR c.fingerprint IS DISTINCT FROM p.fingerprint
+         RETURNING partition_key""",
+        (table_name, table_name)
+    )
+    changed_partitions = sorted(row[0] for row in cursor.fetchall())
+    cursor.execute(f'DELETE FROM {PARTITION_FINGERPRINTS_TABLE} WHERE table_name = %s', (table_name,))
+    cursor.execute(
+        f"""INSERT INTO {PARTITION_FINGERPRINTS_TABLE} (table_name, partition_key, row_count, fingerprint)
+            SELECT %s, partition_key, row_count, fingerprint
+              FROM current_partition_fingerprints""",
+        (table_name,)
+    )
+    cursor.execute('DROP TABLE current_partition_fingerprints')
+    prune_changed_partitions(cursor, table_name)
+    return changed_partitions
+
+def prune_changed_partitions(cursor, table_name: str) -> None:
+    """
+    Deletes the changes of a table that all the models recording their build snapshot have already seen. Nothing is deleted
+    until a model has recorded one, as they might not have read them yet
+    """
+    cursor.execute('SELECT to_regclass(%s)', (MODEL_BUILDS_TABLE,))
+    if cursor.fetchone()[0] is None:
+        return
+    cursor.execute(
+        f"""DELETE FROM {CHANGED_PARTITIONS_TABLE} AS c
+             WHERE table_name = %s
+               AND EXISTS (SELECT 1 FROM {MODEL_BUILDS_TABLE} WHERE built_snapshot IS NOT NULL)
+               AND NOT EXISTS (
+                    SELECT 1
+                      FROM {MODEL_BUILDS_TABLE} AS b
+                     WHERE b.built_snapshot IS NOT NULL
+                       AND NOT txid_visible_in_snapshot(c.load_txid, b.built_snapshot :: txid_snapshot)
+                   )""",
+        (table_name,)
+    )
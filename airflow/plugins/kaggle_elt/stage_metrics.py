@@ -0,0 +1,141 @@
+import io
+import time
+import resource
+
+from contextlib import contextmanager
+from kaggle_elt.load_manifest import ELT_SCHEMA
+from typing import Any, Dict, Iterator, List, Optional
+
+STAGE_METRICS_TABLE = f'{ELT_SCHEMA}.load_stage_metrics'
+
+def reset_peak_rss() -> None:
+    """
+    Resets the peak resident set size of this process to its current one, so the next reading is the peak of the following stage.
+    Only supported on linux; elsewhere the peak is the one of the whole life of the process
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as ofile:
+            ofile.write('5')
+    except OSError:
+        pass
+
+def get_peak_rss() -> int:
+    """Returns the peak resident set size in bytes of this process since it was last reset"""
+    try:
+        with open('/proc/self/status', 'r') as ifile:
+            for line in ifile:
+                if line.startswith('VmHWM:'):
+                    return 1024 * int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on linux (and can't be reset)
+    return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class StageMetrics:
+    """A class representing the performance metrics of a stage of the ELT (download, unzip, sanitize, copy...)"""
+    def __init__(self, stage: str, wall_time: float=0.0, bytes_read: int=0, rows_emitted: int=0, peak_rss: int=0):
+        """Constructs all necessary attributes for the object"""
+        self.stage = stage
+        self.wall_time = wall_time
+        self.bytes_read = bytes_read
+        self.rows_emitted = rows_emitted
+        self.peak_rss = peak_rss
+
+    @property
+    def rows_per_sec(self) -> float:
+        """Returns the throughput of the stage"""
+        return self.rows_emitted / self.wall_time if self.wall_time > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the metrics as a dict, so they can be pushed to XCom"""
+        return {
+            'stage': self.stage,
+            'wall_time': self.wall_time,
+            'bytes_read': self.bytes_read,
+            'rows_emitted': self.rows_emitted,
+            'rows_per_sec': self.rows_per_sec,
+            'peak_rss': self.peak_rss,
+        }
+
+    def __repr__(self) -> str:
+        """Returns a human readable summary of the metrics"""
+        return (
+            f'{self.stage}: {self.wall_time:.2f}s, {self.bytes_read:,} bytes read, {self.rows_emitted:,} rows '
+            f'({self.rows_per_sec:,.0f} rows/s), peak RSS {self.peak_rss / 2**20:,.1f}MB'
+        )
+
+class StageMetricsRecorder:
+    """A class that collects the metrics of all the stages run by a task"""
+    def __init__(self, table_name: str):
+        """Constructs all necessary attributes for the object"""
+        self.table_name = table_name
+        self.stages: List[StageMetrics] = []
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[StageMetrics]:
+        """
+        Times the wrapped block as a stage and measures its peak RSS. Bytes and rows are to be filled in by the caller through the
+        yielded object, as well as the peak RSS of the processes it spawns (e.g. the workers of a partitioned load), if higher
+        """
+        metrics = StageMetrics(stage)
+        reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            metrics.wall_time = time.perf_counter() - start
+            metrics.peak_rss = max(metrics.peak_rss, get_peak_rss())
+            self.stages.append(metrics)
+            print(f'Stage metrics {self.table_name} - {metrics}')
+
+    def add(self, metrics: StageMetrics) -> None:
+        """Adds the metrics of a stage measured elsewhere"""
+        self.stages.append(metrics)
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        """Returns the metrics of all stages as dicts, so they can be pushed to XCom"""
+        return [dict(m.to_dict(), table_name=self.table_name) for m in self.stages]
+
+class TimedReader(io.RawIOBase):
+    """A class that wraps a file-like object and accumulates the time spent reading from it"""
+    def __init__(self, file):
+        """Constructs all necessary attributes for the object"""
+        self._file = file
+        self.read_time = 0.0
+
+    def read(self, n: Optional[int] = None):
+        """Reads n characters (or bytes) from the wrapped file"""
+        start = time.perf_counter()
+        try:
+            return self._file.read(n)
+        finally:
+            self.read_time += time.perf_counter() - start
+
+    def readable(self) -> bool:
+        """Return true to indicate that the object is readable"""
+        return True
+
+def create_stage_metrics_table(cursor) -> None:
+    """Creates the stage metrics table if it doesn't exist"""
+    cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {ELT_SCHEMA};')
+    cursor.execute(
+        f"""CREATE TABLE IF NOT EXISTS {STAGE_METRICS_TABLE} (
+            run_id VARCHAR(255),
+            table_name VARCHAR(255) NOT NULL,
+            stage VARCHAR(50) NOT NULL,
+            wall_time DOUBLE PRECISION NOT NULL,
+            bytes_read BIGINT NOT NULL,
+            rows_emitted BIGINT NOT NULL,
+            rows_per_sec DOUBLE PRECISION NOT NULL,
+            peak_rss BIGINT NOT NULL,
+            recorded_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );"""
+    )
+
+def insert_stage_metrics(cursor, run_id: Optional[str], metrics: List[Dict[str, Any]]) -> None:
+    """Inserts the metrics of a set of stages into the stage metrics table"""
+    cursor.executemany(
+        f"""INSERT INTO {STAGE_METRICS_TABLE} (run_id, table_name, stage, wall_time, bytes_read, rows_emitted, rows_per_sec, peak_rss)
+            VALUES (%(run_id)s, %(table_name)s, %(stage)s, %(wall_time)s, %(bytes_read)s, %(rows_emitted)s, %(rows_per_sec)s, %(peak_rss)s)""",
+        [dict(m, run_id=run_id) for m in metrics]
+    )
@@ -0,0 +1,182 @@
+import io
+import os
+import re
+import json
+import base64
+import zipfile
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from synthetic_data import read_source_configs, write_table_csv
+from typing import Dict, Optional, Tuple
+
+# Like Kaggle, files bigger than this are served compressed
+COMPRESSION_THRESHOLD = 1024 * 1024
+
+class FakeKaggleServer:
+    """
+    A class representing a local stand-in for the Kaggle datasets API, so the downloader can be run offline.
+    Serves the files under {root_dir}/{owner}/{dataset}/{version}/, supports byte ranges and checks basic auth.
+    Setting fail_after & failures makes the next downloads drop the connection after fail_after bytes, to exercise resuming
+    """
+    def __init__(self, root_dir: str, username: str='user', key: str='key', host: str='127.0.0.1', port: int=0):
+        """Constructs all necessary attributes for the object"""
+        self.root_dir = root_dir
+        self.credentials = f'Basic {base64.b64encode(f"{username}:{key}".encode()).decode()}'
+        self.fail_after: Optional[int] = None
+        self.failures = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        self._payloads: Dict[str, bytes] = {}
+        self._server = ThreadingHTTPServer((host, port), self._build_handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Returns the base url of the API, to be passed to the downloader"""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/api/v1'
+
+    def _get_payload(self, dataset: str, version: str, file: str) -> Optional[bytes]:
+        """Returns the bytes served for a file, compressing them if the file is big. Payloads are built once"""
+        file_path = f'{self.root_dir}/{dataset}/{version}/{file}'
+        with self._lock:
+            if file_path not in self._payloads:
+                if not os.path.isfile(file_path):
+                    return None
+                with open(file_path, 'rb') as ifile:
+                    payload = ifile.read()
+                if len(payload) > COMPRESSION_THRESHOLD:
+                    ofile = io.BytesIO()
+                    with zipfile.ZipFile(ofile, 'w', zipfile.ZIP_DEFLATED) as zipped_file:
+                        zipped_file.writestr(file, payload)
+                    payload = ofile.getvalue()
+                self._payloads[file_path] = payload
+            return self._payloads[file_path]
+
+    def _get_versions(self, dataset: str) -> list:
+        """Returns the versions available for a dataset"""
+        dataset_path = f'{self.root_dir}/{dataset}'
+        return sorted(int(v) for v in os.listdir(dataset_path)) if os.path.isdir(dataset_path) else []
+
+    def _build_handler(self):
+        """Builds the request handler class bound to this server"""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                """Silences the request logging"""
+
+            def _send_json(self, status: int, body: dict) -> None:
+                """Sends a json response"""
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _parse_range(self, size: int) -> Optional[Tuple[int, int]]:
+                """Returns the requested byte range, if any"""
+                match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if not match:
+                    return None
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else size - 1
+                return start, min(end, size - 1)
+
+            def do_GET(self):
+                """Serves the dataset view & file download endpoints"""
+                if self.headers.get('Authorization') != server.credentials:
+                    return self._send_json(401, {'message': 'Unauthorized'})
+                url = urlparse(self.path)
+                view = re.match(r'/api/v1/datasets/view/([^/]+/[^/]+)$', url.path)
+                if view:
+                    versions = server._get_versions(view.group(1))
+                    if not versions:
+                        return self._send_json(404, {'message': 'Not found'})
+                    return self._send_json(200, {'ref': view.group(1), 'currentVersionNumber': versions[-1]})
+                download = re.match(r'/api/v1/datasets/download/([^/]+/[^/]+)/(.+)$', url.path)
+                if not download:
+                    return self._send_json(404, {'message': 'Not found'})
+                dataset, file = download.groups()
+                versions = server._get_versions(dataset)
+                version = parse_qs(url.query).get('datasetVersionNumber', [versions[-1] if versions else None])[0]
+                payload = server._get_payload(dataset, str(version), file) if version is not None else None
+                if payload is None:
+                    return self._send_json(404, {'message': 'Not found'})
+                byte_range = self._parse_range(len(payload))
+                if byte_range and byte_range[0] >= len(payload):
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(payload)}')
+                    self.end_headers()
+                    return
+                start, end = byte_range or (0, len(payload) - 1)
+                self.send_response(206 if byte_range else 200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end - start + 1))
+                if byte_range:
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{len(payload)}')
+                self.end_headers()
+                body = payload[start:end + 1]
+                with server._lock:
+                    fail = server.failures > 0 and server.fail_after is not None
+                    if fail:
+                        server.failures -= 1
+                if fail:
+                    # Simulate a dropped connection halfway through the transfer
+                    body = body[:server.fail_after]
+                    self.close_connection = True
+                self.wfile.write(body)
+                with server._lock:
+                    server.bytes_served += len(body)
+
+        return Handler
+
+    def add_file(self, dataset: str, version: int, file: str) -> str:
+        """Returns the path a dataset version's file has to be written to in order to be served"""
+        file_path = f'{self.root_dir}/{dataset}/{version}/{file}'
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return file_path
+
+    def start(self) -> 'FakeKaggleServer':
+        """Starts serving in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops the server"""
+        self._server.shutdown()
+        self._server.server_close()
+
+def write_synthetic_datasets(server: FakeKaggleServer, num_rows: int, version: int=1, seed: int=0) -> None:
+    """Writes synthetic files for all the tables of the sources defined in the repo's dbt project, so the server can serve them"""
+    for source_cfg in read_source_configs():
+        for table_cfg in source_cfg.tables.values():
+            file_path = server.add_file(source_cfg.kaggle_full_name, version, table_cfg.kaggle_file_name)
+            with open(file_path, 'w', encoding=source_cfg.encoding, newline='') as ofile:
+                write_table_csv(ofile, table_cfg, num_rows, source_cfg.null_value, num_accidents=num_rows, seed=seed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves synthetic versions of the dbt sources through a local stand-in for the Kaggle API')
+    parser.add_argument('--root-dir', required=True, help='Directory the synthetic files are written to & served from')
+    parser.add_argument('--rows', type=int, default=200000, help='Number of rows generated per table')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--username', default='user')
+    parser.add_argument('--key', default='key')
+    args = parser.parse_args()
+
+    server = FakeKaggleServer(args.root_dir, args.username, args.key, args.host, args.port)
+    write_synthetic_datasets(server, args.rows)
+    print(f'Serving the Kaggle API at {server.url}. Point the downloader to it by setting KAGGLE_API_URL')
+    try:
+        server.start()._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import io
+import os
+import csv
+import sys
+import random
+import datetime
+
+# Make the airflow plugins importable without an airflow installation
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'airflow', 'plugins'))
+
+from kaggle_elt.kaggle_dbt_source import KaggleDbtSource, KaggleDbtSourceTable, KaggleDbtSourceTableColumn, read_kaggle_dbt_source_configs
+from typing import Callable, Dict, List, Optional
+
+# The raw Kaggle files have 30+ columns, most of which are not loaded
+NUM_FILLER_COLUMNS = 26
+# Share of values that are null, for the columns that allow them
+NULL_RATIO = 0.15
+START_DATE = datetime.date(2005, 1, 1).toordinal()
+END_DATE = datetime.date(2017, 12, 31).toordinal()
+# Values that need quoting or have non-ascii characters, to exercise the sanitizer's edge cases
+EDGE_CASE_VALUES = [
+    'Junction, roundabout',
+    'Car, 4 wheels "estate"',
+    'Dry, "wet" or damp',
+    'Señal de tráfico',
+    'Fine no high winds',
+]
+
+def build_accident_id(i: int) -> str:
+    """Builds a unique accident id with the length of the Accident_Index field"""
+    return f'2005{i:09d}'
+
+def _get_value_generator(column: KaggleDbtSourceTableColumn, rng: random.Random, null_value: str, num_accidents: int) -> Callable[[int], str]:
+    """Builds a function that generates the value of a column for a given row number, according to its declared type & tests"""
+    type_name = column.data_type.split('(')[0].upper().strip()
+    nullable = not column.not_null
+    if column.name == 'accident_id':
+        # Ids are unique in the accidents table and repeat in the vehicles one, like in the real dataset
+        generate = (lambda i: build_accident_id(i)) if column.unique else (lambda i: build_accident_id(rng.randrange(num_accidents)))
+    elif column.accepted_values:
+        generate = lambda i: rng.choice(column.accepted_values)
+    elif type_name == 'DATE':
+        generate = lambda i: datetime.date.fromordinal(rng.randint(START_DATE, END_DATE)).isoformat()
+    elif type_name in ('SMALLINT', 'INTEGER', 'INT', 'BIGINT'):
+        generate = lambda i: str(min(int(rng.expovariate(0.15)), 120))
+    else:
+        generate = lambda i: rng.choice(EDGE_CASE_VALUES)
+    if nullable:
+        return lambda i: null_value if rng.random() < NULL_RATIO else generate(i)
+    return generate
+
+def _get_filler_generator(rng: random.Random) -> Callable[[int], str]:
+    """Builds a function that generates the value of a column that is not loaded"""
+    kind = rng.choice(['int', 'float', 'text'])
+    if kind == 'int':
+        return lambda i: str(rng.randint(-1, 9))
+    if kind == 'float':
+        return lambda i: f'{rng.uniform(-5, 60):.6f}'
+    return lambda i: rng.choice(EDGE_CASE_VALUES + ['NA', ''])
+
+def write_table_csv(
+        ofile,
+        table_cfg: KaggleDbtSourceTable,
+        num_rows: int,
+        null_value: str='NA',
+        num_accidents: Optional[int] = None,
+        seed: int=0
+    ) -> None:
+    """Writes a synthetic csv file with the layout of a source table. The loaded columns are mixed with filler ones"""
+    rng = random.Random(seed)
+    num_accidents = num_accidents or num_rows
+    columns = [
+        (c.kaggle_column_name, _get_value_generator(c, rng, null_value, num_accidents))
+        for c in table_cfg.columns.values()
+    ]
+    columns += [(f'Filler_Column_{i}', _get_filler_generator(rng)) for i in range(NUM_FILLER_COLUMNS)]
+    rng.shuffle(columns)
+    writer = csv.writer(ofile, lineterminator='\n')
+    writer.writerow([name for name, _ in columns])
+    for i in range(num_rows):
+        writer.writerow([generate(i) for _, generate in columns])
+
+def build_table_csv(table_cfg: KaggleDbtSourceTable, num_rows: int, null_value: str='NA', seed: int=0) -> str:
+    """Builds an in-memory synthetic csv file with the layout of a source table"""
+    ofile = io.StringIO()
+    write_table_csv(ofile, table_cfg, num_rows, null_value, seed=seed)
+    return ofile.getvalue()
+
+def write_source_csvs(source_cfg: KaggleDbtSource, download_dir: str, num_rows: int, seed: int=0) -> Dict[str, str]:
+    """
+    Writes a synthetic csv file for each table of a source, using the source's encoding, where the loader expects it.
+    Returns the path of each table's file
+    """
+    download_path = source_cfg.get_download_path(download_dir)
+    os.makedirs(download_path, exist_ok=True)
+    file_paths = {}
+    for table_cfg in source_cfg.tables.values():
+        file_path = f'{download_path}/{table_cfg.kaggle_file_name}'
+        with open(file_path, 'w', encoding=source_cfg.encoding, newline='') as ofile:
+            write_table_csv(ofile, table_cfg, num_rows, source_cfg.null_value, num_accidents=num_rows, seed=seed)
+        file_paths[table_cfg.name] = file_path
+    return file_paths
+
+def read_source_configs() -> List[KaggleDbtSource]:
+    """Reads the configuration of the sources defined in the repo's dbt project"""
+    dbt_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dbt')
+    return list(read_kaggle_dbt_source_configs(dbt_path, 'kaggle').values())
@@ -0,0 +1,30 @@
+{#
+    Returns a query with the partitions of the given source tables that the loader has recorded as changed since the model
+    was last built, cast to the type of the model's partition column. Incremental models filter their input with it, and
+    replace those partitions in full by using the partition column as their unique_key.
+    The model must record its builds with the record_model_build(snapshot=True) post-hook. A change is new if the load that
+    recorded it wasn't committed when the last build started, which (unlike comparing timestamps) doesn't miss loads that
+    started before that build but committed after it. If no build has been recorded, all the recorded changes are new.
+#}
+{% macro changed_partitions(source_relations, data_type='INTEGER') %}
+    {%- set model_builds = adapter.get_relation(database=this.database, schema='kaggle_elt', identifier='model_builds') -%}
+    SELECT DISTINCT partition_key :: {{ data_type }}
+      FROM kaggle_elt.changed_partitions
+     WHERE table_name IN (
+            {%- for relation in source_relations -%}
+                '{{ relation.schema }}.{{ relation.identifier }}'{{ ',' if not loop.last }}
+            {%- endfor -%}
+           )
+       AND partition_key <> ''
+       {%- if model_builds is not none %}
+       AND NOT COALESCE(
+            txid_visible_in_snapshot(
+                load_txid,
+                (SELECT built_snapshot :: txid_snapshot
+                   FROM {{ model_builds }}
+                  WHERE model_name = '{{ this.schema }}.{{ this.identifier }}')
+            ),
+            FALSE
+           )
+       {%- endif %}
+{% endmacro %}
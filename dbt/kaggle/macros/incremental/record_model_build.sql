@@ -0,0 +1,37 @@
+{#
+    Post-hook recording the time of the latest build of a model (and, with snapshot=True, the txid snapshot it ran on) in
+    kaggle_elt.model_builds. The incremental models, the loader & the dashboard read them from there instead of scanning the
+    model. Hooks run in the transaction of the build, so the row is only visible once the build is.
+    The model must have a _built_at column set to NOW() (and a _built_snapshot one set to txid_current_snapshot()). A build
+    that inserts no rows keeps the previous record, so the changes it saw are just looked at again by the next one.
+#}
+{% macro record_model_build(snapshot=False) %}
+    CREATE SCHEMA IF NOT EXISTS kaggle_elt;
+    CREATE TABLE IF NOT EXISTS kaggle_elt.model_builds (
+        model_name VARCHAR(255) PRIMARY KEY,
+        built_at TIMESTAMP NOT NULL,
+        built_snapshot TEXT
+    );
+    INSERT INTO kaggle_elt.model_builds (model_name, built_at, built_snapshot)
+    SELECT '{{ this.schema }}.{{ this.identifier }}', _built_at, {{ '_built_snapshot' if snapshot else 'NULL' }}
+      FROM {{ this }}
+     WHERE _built_at = NOW()
+     LIMIT 1
+    ON CONFLICT (model_name) DO UPDATE
+       SET built_at = EXCLUDED.built_at,
+           built_snapshot = EXCLUDED.built_snapshot
+{% endmacro %}
+
+{#
+    Returns a query with the time of the latest build of the model, or -infinity if it has never been recorded
+#}
+{% macro last_model_build_time() %}
+    {%- set model_builds = adapter.get_relation(database=this.database, schema='kaggle_elt', identifier='model_builds') -%}
+    {%- if model_builds is none -%}
+        SELECT '-infinity' :: TIMESTAMP
+    {%- else -%}
+        SELECT COALESCE(MAX(built_at), '-infinity' :: TIMESTAMP)
+          FROM {{ model_builds }}
+         WHERE model_name = '{{ this.schema }}.{{ this.identifier }}'
+    {%- endif -%}
+{% endmacro %}
@@ -0,0 +1,15 @@
+{# Overrides dbt's accepted_values test to use the invalid values found while loading the source tables #}
+{% test accepted_values(model, column_name, values, quote=True) %}
+    {% set scan_query %}
+        SELECT {{ column_name }} AS value_field
+          FROM {{ model }}
+         WHERE {{ column_name }} NOT IN (
+            {%- for value in values -%}
+                {% if quote %}'{{ value }}'{% else %}{{ value }}{% endif %}{{ ',' if not loop.last }}
+            {%- endfor -%}
+           )
+         GROUP BY 1
+    {% endset %}
+    {#- The loader only records the values of text columns, as they are in the csv #}
+    {{ recorded_or_scanned_failures(model, 'accepted_values', column_name, values | join('|'), scan_query) }}
+{%- endtest -%}
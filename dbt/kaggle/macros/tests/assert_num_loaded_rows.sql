@@ -5,12 +5,16 @@
             | selectattr("name", "equalto", model.identifier)
             | first
         -%}
-        WITH row_count AS (
-            SELECT COUNT(*) as num_rows
-            FROM {{ model }}
-        )
-        SELECT *
-        FROM row_count
-        WHERE num_rows <> {{source_node.meta.expected_rows}}
+        {% set scan_query %}
+            WITH row_count AS (
+                SELECT COUNT(*) as num_rows
+                FROM {{ model }}
+            )
+            SELECT *
+            FROM row_count
+            WHERE num_rows <> {{source_node.meta.expected_rows}}
+        {% endset %}
+        {#- The loader records whether the number of loaded rows matches the expected one #}
+        {{ recorded_or_scanned_failures(model, 'row_count', '', source_node.meta.expected_rows, scan_query) }}
     {% endif %}
-{%- endtest -%}
\ No newline at end of file
+{%- endtest -%}
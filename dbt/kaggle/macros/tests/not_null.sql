@@ -0,0 +1,7 @@
+{# Overrides dbt's not_null test to use the null count recorded while loading the source tables #}
+{% test not_null(model, column_name) %}
+    {% set scan_query %}
+        SELECT * FROM {{ model }} WHERE {{ column_name }} IS NULL
+    {% endset %}
+    {{ recorded_or_scanned_failures(model, 'not_null', column_name, '', scan_query) }}
+{%- endtest -%}
@@ -0,0 +1,29 @@
+{#
+    Returns the failing rows of a test as recorded by the loader, which computes the checks while streaming the source tables into
+    the db. The scan_query is only run if there's no conclusive result for the check (e.g. the table wasn't loaded by the loader, or
+    its accepted values have changed since). Returns one row per failure, as counted by the scan_query.
+#}
+{% macro recorded_or_scanned_failures(model, check_name, column_name, expected, scan_query) %}
+    {%- set quality_checks = adapter.get_relation(database=model.database, schema='kaggle_elt', identifier='load_quality_checks') -%}
+    {%- if quality_checks is none %}
+        SELECT 1 AS failure
+          FROM ({{ scan_query }}) AS scanned_failures
+    {%- else %}
+        WITH recorded_check AS (
+            SELECT failures
+              FROM {{ quality_checks }}
+             WHERE table_name = '{{ model.schema }}.{{ model.identifier }}'
+               AND check_name = '{{ check_name }}'
+               AND column_name = '{{ column_name }}'
+               AND expected = $${{ expected }}$$
+               AND failures IS NOT NULL
+        )
+        SELECT 1 AS failure
+          FROM recorded_check, generate_series(1, recorded_check.failures)
+         UNION ALL
+        -- Postgres only runs the scan if the uncorrelated condition holds
+        SELECT 1 AS failure
+          FROM ({{ scan_query }}) AS scanned_failures
+         WHERE NOT EXISTS (SELECT 1 FROM recorded_check)
+    {%- endif %}
+{% endmacro %}
@@ -0,0 +1,11 @@
+{# Overrides dbt's unique test to use the duplicated values found while loading the source tables #}
+{% test unique(model, column_name) %}
+    {% set scan_query %}
+        SELECT {{ column_name }}
+          FROM {{ model }}
+         WHERE {{ column_name }} IS NOT NULL
+         GROUP BY {{ column_name }}
+        HAVING COUNT(*) > 1
+    {% endset %}
+    {{ recorded_or_scanned_failures(model, 'unique', column_name, '', scan_query) }}
+{%- endtest -%}
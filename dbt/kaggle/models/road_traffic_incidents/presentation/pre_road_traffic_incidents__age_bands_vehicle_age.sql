@@ -1,18 +1,36 @@
 {{
     config(
-        materialized='table'
+        materialized='incremental',
+        unique_key='accident_year',
+        post_hook="{{ record_model_build() }}"
     )
 }}
 
+{% if is_incremental() and 'accident_year' not in adapter.get_columns_in_relation(this) | map(attribute='name') | list %}
+    {{ exceptions.raise_compiler_error(
+        this ~ ' was built as a table by an older version. Rebuild it once with dbt run --full-refresh -m ' ~ this.identifier
+    ) }}
+{% endif %}
+
 WITH road_traffic_incidents AS (
     SELECT * FROM {{ ref('stg_road_traffic_incidents__road_traffic_incidents') }}
+    {% if is_incremental() %}
+     -- Only re-aggregate the years rebuilt in the staging model since the last run (indexed by _built_at)
+     WHERE accident_year IN (
+        SELECT DISTINCT accident_year
+          FROM {{ ref('stg_road_traffic_incidents__road_traffic_incidents') }}
+         WHERE _built_at > ({{ last_model_build_time() }})
+     )
+    {% endif %}
 ),
     age_bands_vehicle_age AS (
-        SELECT vehicle_age,
+        SELECT accident_year,
+               vehicle_age,
                driver_age_band,
-               COUNT(*) AS num_accidents
+               COUNT(*) AS num_accidents,
+               NOW() AS _built_at
           FROM road_traffic_incidents
-         GROUP BY vehicle_age, driver_age_band
+         GROUP BY accident_year, vehicle_age, driver_age_band
     )
 SELECT *
-FROM age_bands_vehicle_age
\ No newline at end of file
+FROM age_bands_vehicle_age
@@ -1,5 +1,25 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key='accident_year',
+        on_schema_change='append_new_columns',
+        indexes=[{'columns': ['accident_year']}, {'columns': ['_built_at']}],
+        post_hook="{{ record_model_build(snapshot=True) }}"
+    )
+}}
+
 WITH accident_information AS (
     SELECT * FROM {{ ref('base_road_traffic_incidents__accident_information') }}
+    {% if is_incremental() %}
+     -- Only the years whose accidents or vehicles changed in the last loads. The vehicles are partitioned by the year in
+     -- their accident_id, which is the year of the accident
+     WHERE EXTRACT(YEAR FROM accident_date) :: INTEGER IN (
+        {{ changed_partitions([
+            source('road_traffic_incidents', 'accident_information'),
+            source('road_traffic_incidents', 'vehicle_information')
+        ]) }}
+     )
+    {% endif %}
 ),
 vehicle_information AS (
     SELECT * FROM {{ ref('base_road_traffic_incidents__vehicle_information') }}
@@ -7,15 +27,18 @@ vehicle_information AS (
     road_traffic_incidents AS (
         SELECT ai.accident_id,
                ai.accident_date,
+               EXTRACT(YEAR FROM ai.accident_date) :: INTEGER AS accident_year,
                ai.accident_day_of_week,
                ai.accident_severity,
                vi.driver_age_band,
                vi.vehicle_age,
                vi.driver_home_area_type,
-               vi.driver_journey_purpose
+               vi.driver_journey_purpose,
+               NOW() AS _built_at,
+               txid_current_snapshot() :: TEXT AS _built_snapshot
           FROM accident_information AS ai
             INNER JOIN vehicle_information AS vi
                 ON ai.accident_id = vi.accident_id
     )
 SELECT *
-FROM road_traffic_incidents
\ No newline at end of file
+FROM road_traffic_incidents
@@ -0,0 +1,131 @@
+import io
+import os
+import sys
+import struct
+import datetime
+
+import pytest
+
+from decimal import Decimal
+
+# Make the airflow plugins importable without an airflow installation
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'airflow', 'plugins'))
+
+from kaggle_elt.binary_copy import PGCOPY_HEADER, PGCOPY_TRAILER, BinaryCopyCSVSanitizer, get_binary_encoder
+
+def _decode_numeric(data: bytes) -> Decimal:
+    """Decodes a postgres binary NUMERIC, the way numeric_recv does"""
+    ndigits, weight, sign, dscale = struct.unpack('!hhHH', data[:8])
+    if sign == 0xC000:
+        return Decimal('NaN')
+    digits = struct.unpack(f'!{ndigits}H', data[8:])
+    value = sum((Decimal(d) * Decimal(10000) ** (weight - i) for i, d in enumerate(digits)), Decimal(0))
+    value = value.quantize(Decimal(1).scaleb(-dscale))
+    return -value if sign == 0x4000 else value
+
+# Decoders of the binary fields by postgres type, the inverse of the encoders
+_DECODERS = {
+    'VARCHAR(32)': lambda d: d.decode('utf-8'),
+    'SMALLINT': lambda d: struct.unpack('!h', d)[0],
+    'INTEGER': lambda d: struct.unpack('!i', d)[0],
+    'BIGINT': lambda d: struct.unpack('!q', d)[0],
+    'REAL': lambda d: struct.unpack('!f', d)[0],
+    'FLOAT(24)': lambda d: struct.unpack('!f', d)[0],
+    'FLOAT(25)': lambda d: struct.unpack('!d', d)[0],
+    'FLOAT': lambda d: struct.unpack('!d', d)[0],
+    'DOUBLE PRECISION': lambda d: struct.unpack('!d', d)[0],
+    'NUMERIC(12, 4)': _decode_numeric,
+    'DATE': lambda d: datetime.date(2000, 1, 1) + datetime.timedelta(days=struct.unpack('!i', d)[0]),
+    'BOOLEAN': lambda d: d == b'\x01',
+}
+
+def _decode_field(data_type: str, field: bytes):
+    """Decodes a sized binary field. NULLs are decoded as None"""
+    size = struct.unpack('!i', field[:4])[0]
+    if size == -1:
+        return None
+    assert size == len(field) - 4
+    return _DECODERS[data_type](field[4:])
+
+@pytest.mark.parametrize('data_type,value,expected', [
+    ('VARCHAR(32)', 'Fatal ñ', 'Fatal ñ'),
+    ('SMALLINT', '-32768', -32768),
+    ('INTEGER', '2147483647', 2147483647),
+    ('INTEGER', '-1', -1),
+    ('BIGINT', '-9223372036854775808', -9223372036854775808),
+    ('REAL', '0.5', 0.5),
+    ('FLOAT(24)', '-1.25', -1.25),
+    ('FLOAT(25)', '0.1', 0.1),
+    ('FLOAT', '-0.1', -0.1),
+    ('DOUBLE PRECISION', '1e300', 1e300),
+    ('DATE', '2000-01-01', datetime.date(2000, 1, 1)),
+    ('DATE', '1979-02-28', datetime.date(1979, 2, 28)),
+    ('DATE', '2024-02-29', datetime.date(2024, 2, 29)),
+])
+def test_encoders_round_trip(data_type, value, expected):
+    assert _decode_field(data_type, get_binary_encoder(data_type)(value)) == expected
+
+@pytest.mark.parametrize('value', [
+    '0', '1', '-1', '0.0001', '-0.0001', '12345678.9', '-12345678.9012', '10000', '100000000', '0.5000', '-00012.30', '1E+3',
+])
+def test_numeric_encoder_round_trips_value_scale_and_sign(value):
+    decoded = _decode_field('NUMERIC(12, 4)', get_binary_encoder('NUMERIC(12, 4)')(value))
+    assert decoded == Decimal(value)
+    assert decoded.as_tuple().exponent == min(Decimal(value).as_tuple().exponent, 0)
+    assert decoded.is_signed() == Decimal(value).is_signed()
+
+def test_numeric_encoder_encodes_nan():
+    assert _decode_field('NUMERIC(12, 4)', get_binary_encoder('NUMERIC(12, 4)')('NaN')).is_nan()
+
+@pytest.mark.parametrize('value,expected', [
+    ('t', True), ('TRUE', True), ('tr', True), ('y', True), ('yes', True), ('on', True), ('1', True), (' true ', True),
+    ('f', False), ('False', False), ('n', False), ('no', False), ('of', False), ('off', False), ('0', False),
+])
+def test_bool_encoder_round_trip(value, expected):
+    assert _decode_field('BOOLEAN', get_binary_encoder('BOOLEAN')(value)) is expected
+
+@pytest.mark.parametrize('value', ['', 'o', 'maybe', '2', 'truth', 'yess'])
+def test_bool_encoder_rejects_unknown_literals(value):
+    with pytest.raises(ValueError):
+        get_binary_encoder('BOOLEAN')(value)
+
+def test_float_precision_selects_float4_or_float8():
+    assert len(get_binary_encoder('FLOAT(1)')('1')) == 8
+    assert len(get_binary_encoder('float (24)')('1')) == 8
+    assert len(get_binary_encoder('FLOAT(25)')('1')) == 12
+    assert len(get_binary_encoder('FLOAT(53)')('1')) == 12
+    assert len(get_binary_encoder('FLOAT')('1')) == 12
+
+def test_unsupported_data_type():
+    with pytest.raises(ValueError):
+        get_binary_encoder('JSONB')
+
+def test_sanitizer_round_trips_rows_with_nulls():
+    column_types = {
+        'accident_id': 'VARCHAR(32)', 'num_vehicles': 'SMALLINT', 'accident_date': 'DATE', 'speed': 'NUMERIC(12, 4)', 'urban': 'BOOLEAN'
+    }
+    mapping = {'Accident_Index': 'accident_id', 'Number_of_Vehicles': 'num_vehicles', 'Date': 'accident_date', 'Speed': 'speed', 'Urban': 'urban'}
+    csv_file = io.StringIO(
+        'Date,Accident_Index,Number_of_Vehicles,Speed,Urban,Ignored\n'
+        '2005-01-04,"200501BS00001",2,-30.5,t,x\n'
+        'NA,200501BS00002,NA,NA,NA,NA\n'
+    )
+    data = BinaryCopyCSVSanitizer(csv_file, mapping, column_types, 'NA', batch_size=1).read()
+    assert data.startswith(PGCOPY_HEADER) and data.endswith(PGCOPY_TRAILER)
+    pos = len(PGCOPY_HEADER)
+    rows = []
+    while pos < len(data) - len(PGCOPY_TRAILER):
+        num_fields = struct.unpack('!h', data[pos:pos + 2])[0]
+        assert num_fields == len(column_types)
+        pos += 2
+        row = []
+        for data_type in column_types.values():
+            size = struct.unpack('!i', data[pos:pos + 4])[0]
+            field_end = pos + 4 + max(size, 0)
+            row.append(_decode_field(data_type, data[pos:field_end]))
+            pos = field_end
+        rows.append(row)
+    assert rows == [
+        ['200501BS00001', 2, datetime.date(2005, 1, 4), Decimal('-30.5'), True],
+        ['200501BS00002', None, None, None, None],
+    ]